@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# compare the old linear scan of china ip ranges with the sorted interval index
+# usage: python benchmarks/china_ip_lookup.py [file with one destination ip per line]
+import os
+import sys
+import time
+import random
+import socket
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fqsocks import china_ip
+
+REAL_IPS = [
+    '8.8.8.8', '74.125.128.199', '173.194.72.103', '203.208.46.146', '115.239.210.27',
+    '220.181.111.188', '123.125.114.144', '31.13.79.17', '199.59.150.7', '180.149.132.47',
+    '61.135.169.125', '111.13.100.92', '202.55.10.1', '114.114.114.114', '1.2.4.8']
+
+
+def measure(func, *args):
+    started_at = time.time()
+    result = func(*args)
+    return time.time() - started_at, result
+
+
+def load_all():
+    elapsed, china_ip_ranges = measure(lambda: list(china_ip.load_china_ip_ranges()))
+    print('parse %s: %0.2f ms' % (china_ip.CHINA_IP_TXT_FILE, elapsed * 1000))
+    elapsed, array_index = measure(china_ip.build_ip_range_index, china_ip_ranges)
+    print('merge %s ranges into %s: %0.2f ms' % (len(china_ip_ranges), len(array_index), elapsed * 1000))
+    implementations = [('scan', china_ip_ranges), ('index', array_index)]
+    if os.path.exists(china_ip.CHINA_IP_BIN_FILE):
+        elapsed, bin_index = measure(china_ip.read_ip_range_index, china_ip.CHINA_IP_BIN_FILE)
+        print('read %s: %0.2f ms' % (china_ip.CHINA_IP_BIN_FILE, elapsed * 1000))
+        implementations.append(('bin', bin_index))
+    return implementations
+
+
+def is_in_by_scan(ip_as_int, china_ip_ranges):
+    for start_ip_as_int, end_ip_as_int in china_ip_ranges:
+        if start_ip_as_int <= ip_as_int <= end_ip_as_int:
+            return True
+    return False
+
+
+def lookup_all(ips, ranges):
+    if isinstance(ranges, list):
+        return [is_in_by_scan(china_ip.ip_to_int(ip), ranges) for ip in ips]
+    return [china_ip.ip_to_int(ip) in ranges for ip in ips]
+
+
+def random_ips(count):
+    return [socket.inet_ntoa(struct.pack('!I', random.randint(0, 0xffffffff))) for i in range(count)]
+
+
+def compare(name, ips, implementations):
+    expected = None
+    report = []
+    for implementation_name, ranges in implementations:
+        elapsed, results = measure(lookup_all, ips, ranges)
+        assert expected is None or expected == results, implementation_name
+        expected = results
+        report.append('%s %0.2f us' % (implementation_name, elapsed * 1000000 / len(ips)))
+    elapsed, results = measure(china_ip.are_china_ips, ips)
+    assert expected == results, 'batch'
+    report.append('batch(%s) %0.2f us' % ('numpy' if china_ip.numpy else 'python', elapsed * 1000000 / len(ips)))
+    print('%s: %s lookups, %s per lookup' % (name, len(ips), ', '.join(report)))
+
+
+def main():
+    implementations = load_all()
+    compare('random', random_ips(5000), implementations)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            real_ips = [line.strip() for line in f if line.strip()]
+    else:
+        real_ips = REAL_IPS * 300
+    compare('real', real_ips, implementations)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# hold idle connections open through ProxyClient.forward and report memory per connection
+# usage: python benchmarks/idle_relay_memory.py --mode events|greenlets [--connections 1000] [--release-buffers-after 1]
+import os
+import sys
+import resource
+import gc
+import argparse
+
+import gevent.monkey
+
+gevent.monkey.patch_all()
+import gevent
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fqsocks.gateways import proxy_client
+from fqsocks import timeouts
+
+
+class NullCounter(object):
+    def received(self, bytes):
+        pass
+
+    def sending(self, bytes):
+        pass
+
+
+def connected_pair(listen_sock):
+    client_sock = socket.create_connection(listen_sock.getsockname())
+    server_sock, _ = listen_sock.accept()
+    return client_sock, server_sock
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--mode', choices=['events', 'greenlets'], default='events')
+    argument_parser.add_argument('--connections', default=1000, type=int)
+    argument_parser.add_argument(
+        '--release-buffers-after', default=0, type=int, help='seconds, 0 to keep the buffers during the run')
+    args = argument_parser.parse_args()
+    timeouts.release_buffers_after = args.release_buffers_after or 3600
+    proxy_client.splice_enabled = False
+    if 'events' == args.mode:
+        proxy_client.event_driven_relay_ports.add(5228)
+    else:
+        proxy_client.event_driven_relay_ports.clear()
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(512)
+    socks = []
+    for i in range(args.connections):
+        socks.append(connected_pair(listen_sock))
+        socks.append(connected_pair(listen_sock))
+    gevent.sleep(0.1)
+    rss_before = rss_bytes()
+    objects_before = len(gc.get_objects())
+    forwards = []
+    for i in range(args.connections):
+        app_sock, downstream_sock = socks[i * 2]
+        upstream_sock, server_sock = socks[i * 2 + 1]
+        upstream_sock.counter = NullCounter()
+        client = proxy_client.ProxyClient(downstream_sock, '10.0.0.1', i, '10.0.0.2', 5228)
+        client.forward_started = True # like a push connection after the first response
+        client.peeked_data = 'x' * 1024 # the captured request
+        client.downstream_rfile.read(0) # http requests are parsed through it
+        forwards.append(gevent.spawn(client.forward, upstream_sock))
+    gevent.sleep(args.release_buffers_after + 1.5)
+    rss_after = rss_bytes()
+    objects_after = len(gc.get_objects())
+    # freed memory stays with the allocator, so objects tell more than rss once buffers are released
+    print('%-9s %s idle connections: %.1f KB rss, %.1f gc tracked objects per connection' % (
+        args.mode, args.connections, (rss_after - rss_before) / 1024.0 / args.connections,
+        float(objects_after - objects_before) / args.connections))
+    gevent.killall(forwards)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# replay synthetic ipv4 packets through nfqueue_ipset.handle_packet and report packets per second
+# usage: python benchmarks/nfqueue_ipset_replay.py [--flows 5000] [--packets 500000]
+import os
+import sys
+import time
+import random
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fqsocks import ip_set
+from fqsocks import nfqueue_ipset
+
+
+class FakeNfqueueElement(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.verdict = None
+
+    def get_payload(self):
+        return self.payload
+
+    def accept(self):
+        self.verdict = 'ACCEPT'
+
+    def drop(self):
+        self.verdict = 'DROP'
+
+    def set_mark(self, mark):
+        self.verdict = mark
+
+    def repeat(self):
+        pass
+
+
+def generate_packets(flows_count, packets_count):
+    # a few flows carry most packets, like real traffic
+    flows = []
+    for i in range(flows_count):
+        src = struct.pack('!I', random.randint(0xc0a80000, 0xc0a8ffff)) # 192.168.x.x
+        dst = struct.pack('!I', random.randint(0x01000000, 0xdfffffff))
+        header = struct.pack('!BBHHHBBH', 0x45, 0, 1500, 0, 0, 64, 6, 0) + src + dst
+        flows.append(header + '\x00' * 20)
+    return [FakeNfqueueElement(flows[min(int(random.paretovariate(1.2)) - 1, flows_count - 1)])
+            for i in range(packets_count)]
+
+
+def replay(packets, verdict_cache_size):
+    nfqueue_ipset.VERDICT_CACHE = nfqueue_ipset.VerdictCache(verdict_cache_size)
+    started_at = time.time()
+    for packet in packets:
+        nfqueue_ipset.handle_packet(packet)
+    elapsed = time.time() - started_at
+    cache = nfqueue_ipset.VERDICT_CACHE
+    print('verdict cache size %s: %d packets/s, hits %s misses %s' % (
+        verdict_cache_size, len(packets) / elapsed, cache.hits_count, cache.misses_count))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--flows', default=5000, type=int)
+    argument_parser.add_argument('--packets', default=500000, type=int)
+    args = argument_parser.parse_args()
+    nfqueue_ipset.IP_SET_INDEX = ip_set.build_ip_set_index()
+    nfqueue_ipset.RULES.append(nfqueue_ipset.Rule.parse('dst,lan,ACCEPT'))
+    nfqueue_ipset.RULES.append(nfqueue_ipset.Rule.parse('dst,china,0xfeed1'))
+    nfqueue_ipset.Rule.DEFAULT = nfqueue_ipset.DefaultRule('ACCEPT')
+    packets = generate_packets(args.flows, args.packets)
+    replay(packets, 0)
+    replay(packets, 65536)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# relay bytes between two loopback connections with the recv/sendall loop, pooled buffers and splice,
+# report throughput and cpu time of this process
+# usage: python benchmarks/relay_throughput.py [--megabytes 512] [--chunk-size 65536]
+import os
+import sys
+import time
+import argparse
+
+import gevent.monkey
+
+gevent.monkey.patch_all()
+import gevent
+import gevent.server
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fqsocks import networking
+
+
+def connected_pair():
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(1)
+    client_sock = socket.create_connection(listen_sock.getsockname())
+    server_sock, _ = listen_sock.accept()
+    listen_sock.close()
+    return client_sock, server_sock
+
+
+def relay_by_copy(from_sock, to_sock, bufsize):
+    while True:
+        data = from_sock.recv(bufsize)
+        if not data:
+            return
+        to_sock.sendall(data)
+
+
+def relay_by_buffer(from_sock, to_sock, bufsize):
+    while networking.relay_through_buffer(from_sock, to_sock, bufsize):
+        pass
+
+
+def relay_by_corked_buffer(from_sock, to_sock, bufsize):
+    networking.set_cork(to_sock, True)
+    while networking.relay_through_buffer(from_sock, to_sock, bufsize, bulk=True):
+        pass
+
+
+def relay_by_splice(from_sock, to_sock, bufsize):
+    while networking.splice_transfer(from_sock, to_sock, bufsize):
+        pass
+
+
+def run(relay, megabytes, bufsize, chunk_size):
+    # source => relay_in ~ relay => relay_out ~ sink
+    source, relay_in = connected_pair()
+    relay_out, sink = connected_pair()
+
+    def produce():
+        chunk = 'x' * chunk_size
+        for i in range(megabytes * 1024 * 1024 / chunk_size):
+            source.sendall(chunk)
+        source.close()
+
+    def consume():
+        received = 0
+        while True:
+            data = sink.recv(65536)
+            if not data:
+                return received
+            received += len(data)
+
+    def forward():
+        relay(relay_in, relay_out, bufsize)
+        relay_out.close()
+
+    started_at = time.time()
+    cpu_started_at = sum(os.times()[:2])
+    greenlets = [gevent.spawn(produce), gevent.spawn(forward), gevent.spawn(consume)]
+    gevent.joinall(greenlets, raise_error=True)
+    elapsed = time.time() - started_at
+    cpu = sum(os.times()[:2]) - cpu_started_at
+    assert greenlets[2].value == megabytes * 1024 * 1024 / chunk_size * chunk_size
+    for sock in (relay_in, sink):
+        sock.close()
+    # producer and consumer run in this process too, so cpu includes their share
+    print('%-14s %8.1f MB/s  cpu %.2fs for %s MB' % (relay.__name__[len('relay_by_'):], megabytes / elapsed, cpu, megabytes))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--megabytes', default=512, type=int)
+    argument_parser.add_argument('--bufsize', default=8192 * 16, type=int)
+    argument_parser.add_argument('--chunk-size', default=65536, type=int, help='bytes per write of the source')
+    args = argument_parser.parse_args()
+    run(relay_by_copy, args.megabytes, args.bufsize, args.chunk_size)
+    run(relay_by_buffer, args.megabytes, args.bufsize, args.chunk_size)
+    run(relay_by_corked_buffer, args.megabytes, args.bufsize, args.chunk_size)
+    socks = connected_pair()
+    splice_supported = networking.is_splice_supported(*socks)
+    for sock in socks:
+        sock.close()
+    if splice_supported:
+        run(relay_by_splice, args.megabytes, args.bufsize, args.chunk_size)
+    else:
+        print('splice is not supported on this platform')
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# record a download through stat.Counter into a stat.Traffic and report time per call, memory held and
+# total_rx time, next to a list of (type, time, bytes) events as the counter used to keep
+# usage: python benchmarks/stat_counter.py [--megabytes 1024] [--chunk-size 8192]
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fqsocks import stat
+
+
+class EventListCounter(object):
+    def __init__(self):
+        self.events = []
+
+    def sending(self, bytes_count):
+        self.events.append(('tx', time.time(), bytes_count))
+
+    def received(self, bytes_count):
+        self.events.append(('rx', time.time(), bytes_count))
+
+    def total_rx(self, after=0):
+        return sum(event_bytes for event_type, event_time, event_bytes in self.events
+                   if event_time > after and 'rx' == event_type)
+
+    def memory_size(self):
+        return sys.getsizeof(self.events) + len(self.events) * (
+            sys.getsizeof(('rx', 0.0, 0)) + sys.getsizeof(0.0) + sys.getsizeof(0))
+
+
+class TrafficCounter(stat.Counter):
+    def __init__(self):
+        super(TrafficCounter, self).__init__(None, '', '')
+        self.traffic = stat.Traffic()
+        self.traffics.append(self.traffic)
+
+    def total_rx(self, after=0):
+        return self.traffic.total_rx(after)
+
+    def memory_size(self):
+        return sys.getsizeof(self.traffic.buckets)
+
+
+def run(name, counter, calls_count, chunk_size):
+    started_at = time.time()
+    for i in xrange(calls_count):
+        if not i % 64:
+            counter.sending(512)
+        counter.received(chunk_size)
+    record_seconds = time.time() - started_at
+    started_at = time.time()
+    counter.total_rx(0)
+    total_seconds = time.time() - started_at
+    print('%-10s %.2f us per call, %8.1f KB held, total_rx %.3f ms' % (
+        name, record_seconds * 1000000 / calls_count, counter.memory_size() / 1024.0, total_seconds * 1000))
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--megabytes', default=1024, type=int)
+    argument_parser.add_argument('--chunk-size', default=8192, type=int)
+    args = argument_parser.parse_args()
+    calls_count = args.megabytes * 1024 * 1024 / args.chunk_size
+    run('events', EventListCounter(), calls_count, args.chunk_size)
+    run('buckets', TrafficCounter(), calls_count, args.chunk_size)
+
+
+if '__main__' == __name__:
+    main()
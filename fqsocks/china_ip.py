@@ -1,15 +1,54 @@
+#!/usr/bin/env python
 import socket
 import struct
 import math
 import os
+import sys
+import array
+import hashlib
+import bisect
+import argparse
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 LOGGER = logging.getLogger(__name__)
+CHINA_IP_TXT_FILE = os.path.join(os.path.dirname(__file__), 'china_ip.txt')
+CHINA_IP_BIN_FILE = os.path.join(os.path.dirname(__file__), 'china_ip.bin')
+BIN_MAGIC = 'FQI2'
+BIN_HEADER = struct.Struct('!4s20sI') # magic, sha1 of the text file compiled from, ranges count
+BIN_RANGE = struct.Struct('!II') # start, end (inclusive)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    sub_parsers = argument_parser.add_subparsers()
+    compile_parser = sub_parsers.add_parser('compile', help='compile apnic delegated file into packed binary file')
+    compile_parser.add_argument('--input', default=CHINA_IP_TXT_FILE)
+    compile_parser.add_argument('--output', default=CHINA_IP_BIN_FILE)
+    compile_parser.set_defaults(handler=lambda args: compile_china_ip(args.input, args.output))
+    args = argument_parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args.handler(args)
+
 
-def load_china_ip_ranges():
-    with open(os.path.join(os.path.dirname(__file__), 'china_ip.txt')) as f:
-        line = f.readline()
-        while line:
+def compile_china_ip(txt_file, bin_file):
+    ip_range_index = build_ip_range_index(load_china_ip_ranges(txt_file))
+    tmp_file = '%s.tmp' % bin_file
+    with open(tmp_file, 'wb') as f:
+        f.write(BIN_HEADER.pack(BIN_MAGIC, file_sha1(txt_file), len(ip_range_index)))
+        for start_ip_as_int, end_ip_as_int in ip_range_index:
+            f.write(BIN_RANGE.pack(start_ip_as_int, end_ip_as_int))
+    os.rename(tmp_file, bin_file)
+    LOGGER.info('compiled %s ranges from %s into %s' % (len(ip_range_index), txt_file, bin_file))
+
+
+def load_china_ip_ranges(txt_file=CHINA_IP_TXT_FILE):
+    with open(txt_file) as f:
+        for line in f:
             line = line.strip()
             if not line:
                 continue
@@ -22,7 +61,6 @@ def load_china_ip_ranges():
             start_ip_as_int = ip_to_int(start_ip)
             end_ip_as_int = start_ip_as_int + int(ip_count)
             yield start_ip_as_int, end_ip_as_int
-            line = f.readline()
     yield translate_ip_range('111.0.0.0', 10) # china mobile
     yield translate_ip_range('202.55.0.0', 19) # china telecom
 
@@ -32,14 +70,107 @@ def translate_ip_range(ip, netmask):
 
 
 def ip_to_int(ip):
-    return struct.unpack('!i', socket.inet_aton(ip))[0]
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def build_ip_range_index(ip_ranges):
+    # merge overlapping or adjacent ranges, then keep them as two sorted uint32 arrays
+    # ends are inclusive, the same as the (start, end) tuples yielded by the loaders
+    starts = array.array('I')
+    ends = array.array('I')
+    for start_ip_as_int, end_ip_as_int in sorted(ip_ranges):
+        end_ip_as_int = min(end_ip_as_int, 0xffffffff)
+        if ends and start_ip_as_int <= ends[-1] + 1:
+            if end_ip_as_int > ends[-1]:
+                ends[-1] = end_ip_as_int
+        else:
+            starts.append(start_ip_as_int)
+            ends.append(end_ip_as_int)
+    return IpRangeIndex(starts, ends)
+
+
+class IpRangeIndex(object):
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __contains__(self, ip_as_int):
+        i = bisect.bisect_right(self.starts, ip_as_int) - 1
+        return i >= 0 and ip_as_int <= self.ends[i]
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def numpy_columns(self):
+        return numpy.frombuffer(self.starts, dtype=numpy.uint32), numpy.frombuffer(self.ends, dtype=numpy.uint32)
+
+    def memory_size(self):
+        return sys.getsizeof(self.starts) + sys.getsizeof(self.ends)
 
+    def __len__(self):
+        return len(self.starts)
 
-CHINA_IP_RANGES = list(load_china_ip_ranges())
+
+def read_ip_range_index(bin_file, txt_file=None):
+    # the packed pairs go into the two arrays as they are, no text is parsed.
+    # returns None if txt_file is given but bin_file was not compiled from its current content
+    with open(bin_file, 'rb') as f:
+        content = f.read()
+    if len(content) < BIN_HEADER.size:
+        raise Exception('invalid china ip binary file: %s' % bin_file)
+    magic, digest, count = BIN_HEADER.unpack_from(content, 0)
+    if BIN_MAGIC != magic or len(content) != BIN_HEADER.size + count * BIN_RANGE.size:
+        raise Exception('invalid china ip binary file: %s' % bin_file)
+    if txt_file and file_sha1(txt_file) != digest:
+        return None
+    pairs = array.array('I')
+    pairs.fromstring(content[BIN_HEADER.size:])
+    if 'little' == sys.byteorder:
+        pairs.byteswap()
+    return IpRangeIndex(pairs[0::2], pairs[1::2])
+
+
+def file_sha1(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def load_china_ip_index():
+    # the binary file is used only if it was compiled from the text file as it is now,
+    # mtimes say nothing after a checkout or a copy
+    if os.path.exists(CHINA_IP_BIN_FILE):
+        try:
+            ip_range_index = read_ip_range_index(
+                CHINA_IP_BIN_FILE, CHINA_IP_TXT_FILE if os.path.exists(CHINA_IP_TXT_FILE) else None)
+            if ip_range_index is not None:
+                return ip_range_index
+            LOGGER.info('%s was not compiled from the current %s' % (CHINA_IP_BIN_FILE, CHINA_IP_TXT_FILE))
+        except:
+            LOGGER.exception('failed to read %s, fall back to %s' % (CHINA_IP_BIN_FILE, CHINA_IP_TXT_FILE))
+    return build_ip_range_index(load_china_ip_ranges())
+
+
+def classify_ips(ips, ip_range_index):
+    # one bool per ip, for offline jobs classifying thousands of ips at once
+    if not ips:
+        return []
+    if numpy is None:
+        return [ip_to_int(ip) in ip_range_index for ip in ips]
+    starts, ends = ip_range_index.numpy_columns()
+    ips_as_int = numpy.frombuffer(''.join(socket.inet_aton(ip) for ip in ips), dtype='>u4')
+    indices = numpy.searchsorted(starts, ips_as_int, side='right') - 1
+    return ((indices >= 0) & (ips_as_int <= ends[numpy.maximum(indices, 0)])).tolist()
+
+
+CHINA_IP_INDEX = load_china_ip_index()
 
 def is_china_ip(ip):
-    ip_as_int = ip_to_int(ip)
-    for start_ip_as_int, end_ip_as_int in CHINA_IP_RANGES:
-        if start_ip_as_int <= ip_as_int <= end_ip_as_int:
-            return True
-    return False
\ No newline at end of file
+    return ip_to_int(ip) in CHINA_IP_INDEX
+
+
+def are_china_ips(ips):
+    return classify_ips(ips, CHINA_IP_INDEX)
+
+
+if '__main__' == __name__:
+    main()
@@ -58,6 +58,8 @@ def read_config():
     config['ifconfig_command'] = cli_args.ifconfig_command
     config['outbound_ip'] = cli_args.outbound_ip
     config['google_host'] = cli_args.google_host
+    config['host_set'] = dict(host_set.split('=', 1) for host_set in cli_args.host_set)
+    config['hub_monitor_enabled'] = cli_args.hub_monitor_enabled
     for props in cli_args.proxy:
         props = props.split(',')
         prop_dict = dict(p.split('=') for p in props[1:])
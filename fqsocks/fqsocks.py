@@ -16,11 +16,14 @@ from .proxies.http_try import detect_if_ttl_being_ignored
 from .proxies.goagent import GoAgentProxy
 import httpd
 import networking
+import hub_monitor
+import host_set
 from .gateways import proxy_client
 from .gateways import tcp_gateway
 from .gateways import http_gateway
 from .pages import lan_device
 from .pages import home
+from .pages import reloadable_sets
 from . import config_file
 
 
@@ -103,6 +106,12 @@ def init_config(argv):
     argument_parser.add_argument('--log-file')
     argument_parser.add_argument('--proxy', action='append', default=[], help='for example --proxy goagent,appid=abcd')
     argument_parser.add_argument('--google-host', action='append', default=[])
+    argument_parser.add_argument(
+        '--host-set', action='append', default=[],
+        help='name=file, patterns added to a host set and reloaded on change, for example no_direct=/data/no-direct.txt')
+    argument_parser.add_argument(
+        '--hub-monitor', dest='hub_monitor_enabled', action='store_true',
+        help='report greenlets blocking the hub, wakes up every 50ms even when idle')
     argument_parser.add_argument('--access-check', dest='access_check_enabled', action='store_true')
     argument_parser.add_argument('--no-access-check', dest='access_check_enabled', action='store_false')
     argument_parser.set_defaults(access_check_enabled=None)
@@ -132,6 +141,7 @@ def init_config(argv):
     fqdns.OUTBOUND_IP = config['outbound_ip']
     if config['google_host']:
         GoAgentProxy.GOOGLE_HOSTS = config['google_host']
+    host_set.HOST_SET_FILES = config['host_set']
     proxy_client.china_shortcut_enabled = config['china_shortcut_enabled']
     proxy_client.direct_access_enabled = config['direct_access_enabled']
     proxy_client.tcp_scrambler_enabled = config['tcp_scrambler_enabled']
@@ -151,6 +161,8 @@ def main(argv=None):
         gevent.monkey.patch_ssl()
     except:
         LOGGER.exception('failed to patch ssl')
+    if config['hub_monitor_enabled']:
+        hub_monitor.start()
     greenlets = []
     if config['dns_server']['enabled']:
         dns_server_address = (config['dns_server']['ip'], config['dns_server']['port'])
@@ -166,6 +178,7 @@ def main(argv=None):
         httpd.server_greenlet = gevent.spawn(httpd.serve_forever)
         greenlets.append(httpd.server_greenlet)
     greenlets.append(gevent.spawn(proxy_client.init_proxies, config))
+    reloadable_sets.watch_greenlet = gevent.spawn(reloadable_sets.watch_files)
     if proxy_client.tcp_scrambler_enabled:
         if detect_if_ttl_being_ignored():
             proxy_client.tcp_scrambler_enabled = False
@@ -47,7 +47,7 @@ def handle(downstream_sock, address):
         if not dst_ip:
             return
         downstream_sock.sendall('HTTP/1.1 200 OK\r\n\r\n')
-        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port)
+        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port, gateway='http')
         handle_client(client)
     else:
         dst_host = urlparse.urlparse(path)[1]
@@ -59,7 +59,7 @@ def handle(downstream_sock, address):
         dst_ip = resolve_ip(dst_host)
         if not dst_ip:
             return
-        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port)
+        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port, gateway='http')
         request_lines = ['%s %s HTTP/1.1\r\n' % (method, path[path.find(dst_host) + len(dst_host):])]
         headers.pop('Proxy-Connection', None)
         headers['Host'] = dst_host
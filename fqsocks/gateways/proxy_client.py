@@ -1,7 +1,6 @@
 import logging
 import sys
 import socket
-import errno
 import select
 import random
 import re
@@ -9,6 +8,7 @@ import math
 import traceback
 import time
 import contextlib
+import functools
 import fqdns
 import ssl
 import urlparse
@@ -16,6 +16,9 @@ import gevent
 import dpkt
 from .. import networking
 from .. import stat
+from .. import timeouts
+from .. import metrics
+from .. import sketches
 from ..proxies.http_try import NotHttp
 from ..proxies.http_try import HTTP_TRY_PROXY
 from ..proxies.http_try import GOOGLE_SCRAMBLER
@@ -33,6 +36,7 @@ from .. import china_ip
 from ..proxies.direct import DIRECT_PROXY
 from ..proxies.direct import HTTPS_TRY_PROXY
 from ..proxies.direct import NONE_PROXY
+from ..proxies.registry import REGISTRY
 from .. import ip_substitution
 import os.path
 
@@ -70,16 +74,22 @@ goagent_public_servers_enabled = True
 ss_public_servers_enabled = True
 last_refresh_started_at = -1
 force_us_ip = False
+splice_enabled = True
+event_driven_relay_ports = set([5228]) # long lived and mostly idle, relayed without greenlets
+interactive_ports = set([22, 5228]) # small writes go out at once, http downloads are corked instead
 
 
 class ProxyClient(object):
-    def __init__(self, downstream_sock, src_ip, src_port, dst_ip, dst_port):
+    def __init__(self, downstream_sock, src_ip, src_port, dst_ip, dst_port, gateway=None):
         super(ProxyClient, self).__init__()
         self.downstream_sock = downstream_sock
-        self.downstream_rfile = downstream_sock.makefile('rb', 8192)
-        self.downstream_wfile = downstream_sock.makefile('wb', 0)
+        self.gateway = gateway
+        self.stage_started_at = time.time() # accepted, or the time passed to stage_done
+        self.stages = [] # (stage, seconds, proxy) from accept to the first upstream byte
+        self._downstream_rfile = None # made on first use, dropped again when idle
+        self._downstream_wfile = None
         self.forward_started = False
-        self.resources = [self.downstream_sock, self.downstream_rfile, self.downstream_wfile]
+        self.resources = [self.downstream_sock]
         self.src_ip = src_ip
         self.src_port = src_port
         self.dst_ip = dst_ip
@@ -93,8 +103,48 @@ class ProxyClient(object):
         self.delayed_penalties = []
         self.ip_substituted = False
 
+    @property
+    def downstream_rfile(self):
+        if self._downstream_rfile is None:
+            self._downstream_rfile = self.downstream_sock.makefile('rb', 8192)
+            self.resources.append(self._downstream_rfile)
+        return self._downstream_rfile
+
+    @property
+    def downstream_wfile(self):
+        if self._downstream_wfile is None:
+            self._downstream_wfile = self.downstream_sock.makefile('wb', 0)
+            self.resources.append(self._downstream_wfile)
+        return self._downstream_wfile
+
+    def release_buffers(self):
+        # called by the timing wheel once the forward has been idle for a while,
+        # the captured request is not needed any more as fall back can not happen after forward started
+        if not self.forward_started:
+            return
+        self.peeked_data = ''
+        if hasattr(self, 'payload'):
+            self.payload = ''
+        self.delayed_penalties = []
+        if self._downstream_rfile is not None and not self._downstream_rfile._rbuf.getvalue():
+            self.resources.remove(self._downstream_rfile)
+            self._downstream_rfile.close()
+            self._downstream_rfile = None
+        if self._downstream_wfile is not None:
+            self.resources.remove(self._downstream_wfile)
+            self._downstream_wfile.close()
+            self._downstream_wfile = None
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('[%s] idle, buffers released' % repr(self))
+
+    def stage_done(self, stage, started_at=None):
+        now = time.time()
+        self.stages.append((stage, now - (started_at or self.stage_started_at), self.forwarding_by))
+        self.stage_started_at = now
+
     def create_tcp_socket(self, server_ip, server_port, connect_timeout):
         upstream_sock = networking.create_tcp_socket(server_ip, server_port, connect_timeout)
+        self.stage_done('upstream_connect')
         upstream_sock.counter = stat.opened(upstream_sock, self.forwarding_by, self.host, self.dst_ip)
         self.resources.append(upstream_sock)
         self.resources.append(upstream_sock.counter)
@@ -106,39 +156,62 @@ class ProxyClient(object):
     def forward(self, upstream_sock, timeout=7, after_started_timeout=360, bufsize=8192, encrypt=None, decrypt=None,
                 delayed_penalty=None, on_forward_started=None):
 
+        self.stage_done('request_send')
         self.buffer_multiplier = 1
-        if self.forward_started:
-            if 5228 == self.dst_port: # Google Service
-                upstream_sock.settimeout(None)
-            else: # More than 5 minutes
-                upstream_sock.settimeout(after_started_timeout)
-        else:
-            upstream_sock.settimeout(timeout)
+        if 5228 == self.dst_port: # Google Service
+            after_started_timeout = None
+        # first byte and idle timeouts are kept by the timing wheel, not by the socket
+        upstream_sock.settimeout(None)
         self.downstream_sock.settimeout(None)
 
+        def on_expired():
+            if relay:
+                relay.finish(socket.timeout('timed out'))
+            else:
+                u2d.kill(socket.timeout('timed out'), block=False)
+
+        relay = None
+        deadline = timeouts.Deadline(
+            repr(self), on_expired, after_started_timeout if self.forward_started else timeout,
+            lifetime=timeouts.max_connection_lifetime, on_idle=self.release_buffers)
+
+        def on_first_byte_received():
+            self.stage_done('first_byte')
+            self.forward_started = True
+            deadline.set_timeout(after_started_timeout)
+            self.apply_delayed_penalties()
+            if on_forward_started:
+                on_forward_started()
+
+        def on_received_from_upstream(received):
+            # before the bytes go downstream, a client gone or slow while they are written
+            # must not look like an upstream never answering
+            upstream_sock.counter.received(received)
+            deadline.touch()
+            if received and not self.forward_started:
+                on_first_byte_received()
+
         def from_upstream_to_downstream():
             try:
                 while True:
-                    data = upstream_sock.recv(bufsize * self.buffer_multiplier)
-                    upstream_sock.counter.received(len(data))
-                    self.buffer_multiplier = min(16, self.buffer_multiplier + 1)
-                    if data:
-                        if not self.forward_started:
-                            self.forward_started = True
-                            if 5228 == self.dst_port: # Google Service
-                                upstream_sock.settimeout(None)
-                            else: # More than 5 minutes
-                                upstream_sock.settimeout(after_started_timeout)
-                            self.apply_delayed_penalties()
-                            if on_forward_started:
-                                on_forward_started()
+                    if decrypt or not hasattr(upstream_sock, 'recv_into'):
+                        data = upstream_sock.recv(bufsize * self.buffer_multiplier)
+                        on_received_from_upstream(len(data))
+                        self.buffer_multiplier = min(16, self.buffer_multiplier + 1)
+                        if not data:
+                            return
                         if decrypt:
                             data = decrypt(data)
                         self.downstream_sock.sendall(data)
-                    else:
-                        return
+                    else: # no copy into python string, decrypt needs one
+                        received = networking.relay_through_buffer(
+                            upstream_sock, self.downstream_sock, bufsize * self.buffer_multiplier, bulk=bulk,
+                            on_received=on_received_from_upstream)
+                        self.buffer_multiplier = min(16, self.buffer_multiplier + 1)
+                        if not received:
+                            return
             except socket.error as e:
-                if e[0] not in (10053, 10054, 10057, errno.EPIPE):
+                if e[0] not in networking.CONNECTION_CLOSED_ERRORS:
                     return e
             except gevent.GreenletExit:
                 return
@@ -147,8 +220,17 @@ class ProxyClient(object):
                 return sys.exc_info()[1]
 
         def from_downstream_to_upstream():
+            half_closed = False
             try:
                 while True:
+                    if not encrypt and hasattr(upstream_sock, 'recv_into'):
+                        sent = networking.relay_through_buffer(self.downstream_sock, upstream_sock, bufsize)
+                        self.buffer_multiplier = 1
+                        if sent:
+                            upstream_sock.counter.sending(sent)
+                            continue
+                        half_closed = self.half_close(upstream_sock, deadline)
+                        return
                     data = self.downstream_sock.recv(bufsize)
                     self.buffer_multiplier = 1
                     if data:
@@ -157,9 +239,10 @@ class ProxyClient(object):
                         upstream_sock.counter.sending(len(data))
                         upstream_sock.sendall(data)
                     else:
+                        half_closed = self.half_close(upstream_sock, deadline)
                         return
             except socket.error as e:
-                if e[0] not in (10053, 10054, 10057, errno.EPIPE):
+                if e[0] not in networking.CONNECTION_CLOSED_ERRORS:
                     return e
             except gevent.GreenletExit:
                 return
@@ -167,14 +250,82 @@ class ProxyClient(object):
                 LOGGER.exception('forward d2u failed')
                 return sys.exc_info()[1]
             finally:
-                upstream_sock.close()
+                if not half_closed:
+                    upstream_sock.close()
+
+        def splice_from_upstream_to_downstream():
+            try:
+                while True:
+                    moved = networking.splice_transfer(
+                        upstream_sock, self.downstream_sock, bufsize * 16, bulk=bulk,
+                        on_received=on_received_from_upstream)
+                    if not moved:
+                        return
+            except socket.error as e:
+                if e[0] not in networking.CONNECTION_CLOSED_ERRORS:
+                    return e
+            except gevent.GreenletExit:
+                return
+            except:
+                LOGGER.exception('splice u2d failed')
+                return sys.exc_info()[1]
 
-        u2d = gevent.spawn(from_upstream_to_downstream)
-        d2u = gevent.spawn(from_downstream_to_upstream)
+        def splice_from_downstream_to_upstream():
+            half_closed = False
+            try:
+                while True:
+                    moved = networking.splice_transfer(self.downstream_sock, upstream_sock, bufsize)
+                    if moved:
+                        upstream_sock.counter.sending(moved)
+                    else:
+                        half_closed = self.half_close(upstream_sock, deadline)
+                        return
+            except socket.error as e:
+                if e[0] not in networking.CONNECTION_CLOSED_ERRORS:
+                    return e
+            except gevent.GreenletExit:
+                return
+            except:
+                LOGGER.exception('splice d2u failed')
+                return sys.exc_info()[1]
+            finally:
+                if not half_closed:
+                    upstream_sock.close()
+
+        def on_received_by_events(received):
+            upstream_sock.counter.received(received)
+            deadline.touch()
+
+        if self.dst_port in interactive_ports:
+            networking.set_nodelay(upstream_sock)
+            networking.set_nodelay(self.downstream_sock)
+        timeouts.WHEEL.add(deadline)
+        bulk = False
+        if self.dst_port in event_driven_relay_ports and not encrypt and not decrypt \
+                and networking.is_plain_socket(upstream_sock, self.downstream_sock):
+            relay = networking.EventDrivenRelay(
+                upstream_sock, self.downstream_sock, bufsize,
+                on_received=on_received_by_events, on_sending=upstream_sock.counter.sending,
+                on_first_byte_received=on_first_byte_received,
+                on_downstream_eof=functools.partial(self.half_close, upstream_sock, deadline))
+        else:
+            bulk = 'HTTP' == self.protocol and self.dst_port not in interactive_ports \
+                and not decrypt and hasattr(upstream_sock, 'recv_into') \
+                and networking.set_cork(self.downstream_sock, True)
+            if splice_enabled and not encrypt and not decrypt \
+                    and networking.is_splice_supported(upstream_sock, self.downstream_sock):
+                u2d = gevent.spawn(splice_from_upstream_to_downstream)
+                d2u = gevent.spawn(splice_from_downstream_to_upstream)
+            else:
+                u2d = gevent.spawn(from_upstream_to_downstream)
+                d2u = gevent.spawn(from_downstream_to_upstream)
         try:
-            e = u2d.join()
-            if e:
-                raise e
+            if relay:
+                relay.run() # like the forward greenlets, a failed relay just ends without raising
+            else:
+                e = u2d.join()
+                if e:
+                    raise e
             try:
                 upstream_sock.close()
             except:
@@ -182,14 +333,28 @@ class ProxyClient(object):
             if not self.forward_started:
                 self.fall_back(reason='forward does not receive any response', delayed_penalty=delayed_penalty)
         finally:
-            try:
-                u2d.kill()
-            except:
-                pass
-            try:
-                d2u.kill()
-            except:
-                pass
+            timeouts.WHEEL.cancel(deadline)
+            if not relay:
+                try:
+                    u2d.kill()
+                except:
+                    pass
+                try:
+                    d2u.kill()
+                except:
+                    pass
+            if bulk:
+                networking.set_cork(self.downstream_sock, False)
+
+    def half_close(self, upstream_sock, deadline):
+        # downstream sent eof, pass it on and keep relaying the response until upstream closes too,
+        # returns False if upstream can not be half closed (ssl) and should be closed instead
+        if not networking.shutdown_write(upstream_sock):
+            return False
+        deadline.limit_timeout(timeouts.half_close_linger) # the first byte must not raise it again
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('[%s] downstream half closed' % repr(self))
+        return True
 
     def apply_delayed_penalties(self):
         for delayed_penalty in self.delayed_penalties:
@@ -213,6 +378,8 @@ class ProxyClient(object):
             raise Exception('!!! fall back can not happen after forward started !!!')
         if delayed_penalty:
             self.delayed_penalties.append(delayed_penalty)
+        metrics.fell_back(self.forwarding_by, reason)
+        self.stage_done('fall_back')
         raise ProxyFallBack(reason, silently=silently)
 
     def dump_proxies(self):
@@ -269,11 +436,13 @@ def handle_client(client):
             LOGGER.info('[%s] done with error: %s' % (repr(client), err_msg))
     finally:
         client.close()
+        metrics.stages_done(client.forwarding_by, client.stages)
 
 
 def pick_proxy_and_forward(client):
     global dns_polluted_at
     if lan_ip.is_lan_traffic(client.src_ip, client.dst_ip):
+        client.stage_done('classify_ip')
         try:
             DIRECT_PROXY.forward(client)
         except ProxyFallBack:
@@ -282,25 +451,32 @@ def pick_proxy_and_forward(client):
     if client.dst_ip in fqdns.WRONG_ANSWERS:
         LOGGER.error('[%s] destination is GFW wrong answer' % repr(client))
         dns_polluted_at = time.time()
+        client.stage_done('classify_ip')
         NONE_PROXY.forward(client)
         return
     if china_shortcut_enabled and china_ip.is_china_ip(client.dst_ip):
+        client.stage_done('classify_ip')
         try:
             DIRECT_PROXY.forward(client)
         except ProxyFallBack:
             pass
         return
+    client.stage_done('classify_ip')
     if should_fix():
         gevent.spawn(fix_by_refreshing_proxies)
     peek_data(client)
+    client.stage_done('peek_data')
     if china_shortcut_enabled and client.host and fqdns.is_china_domain(client.host):
+        client.stage_done('classify_domain')
         try:
             DIRECT_PROXY.forward(client)
         except ProxyFallBack:
             pass
         return
+    client.stage_done('classify_domain')
     for i in range(3):
         proxy = pick_proxy(client)
+        client.stage_done('pick_proxy')
         if not proxy:
             raise NoMoreProxy()
         if 'DIRECT' in proxy.flags:
@@ -314,6 +490,7 @@ def pick_proxy_and_forward(client):
             if not e.silently:
                 LOGGER.error('[%s] fall back to other proxy due to %s: %s' % (repr(client), e.reason, repr(proxy)))
             client.tried_proxies[proxy] = e.reason
+            sketches.fell_back(metrics.proxy_name(proxy), client.host or client.dst_ip, e.reason)
         except NotHttp:
             try:
                 return DIRECT_PROXY.forward(client)
@@ -350,16 +527,15 @@ class NoMoreProxy(Exception):
 
 
 def should_fix():
+    REGISTRY.sync(proxies)
     if not goagent_public_servers_enabled:
         http_proxies_died = False
     else:
-        http_proxies_died = all(proxy.died for proxy in proxies if
-                                proxy.is_protocol_supported('HTTP'))
+        http_proxies_died = REGISTRY.all_died('HTTP')
     if not ss_public_servers_enabled:
         https_proxies_died = False
     else:
-        https_proxies_died = all(proxy.died for proxy in proxies if
-                                 proxy.is_protocol_supported('HTTPS'))
+        https_proxies_died = REGISTRY.all_died('HTTPS')
     if auto_fix_enabled and (http_proxies_died or https_proxies_died):
         LOGGER.info('http %s https %s, refresh proxies: %s' %
                     (http_proxies_died, https_proxies_died, proxies))
@@ -444,19 +620,9 @@ def pick_https_try_proxy(client):
 
 
 def pick_proxy_supports(client):
-    supported_proxies = [proxy for proxy in proxies if
-                         proxy.is_protocol_supported(client.protocol, client)
-                         and not proxy.died and not client.has_tried(proxy)]
-    if not supported_proxies:
-        return None
-    prioritized_proxies = {}
-    for proxy in supported_proxies:
-        prioritized_proxies.setdefault(proxy.priority, []).append(proxy)
-    highest_priority = sorted(prioritized_proxies.keys())[0]
-    picked_proxy = random.choice(sorted(prioritized_proxies[highest_priority], key=lambda proxy: proxy.latency)[:3])
-    if picked_proxy.latency == 0:
-        return random.choice(prioritized_proxies[highest_priority])
-    return picked_proxy
+    # random one of the 3 lowest latency scores among the highest priority live proxies not tried yet
+    REGISTRY.sync(proxies)
+    return REGISTRY.pick(client.protocol, client.has_tried)
 
 
 def fix_by_refreshing_proxies():
@@ -494,6 +660,7 @@ def refresh_proxies():
             sock.close()
         except:
             pass
+    REGISTRY.build(proxies) # dynamic proxies might delegate to other proxies now
     LOGGER.info('%s, refreshed proxies: %s' % (success, proxies))
     return success
 
@@ -695,4 +862,4 @@ def clear_proxy_states():
     GoAgentProxy.black_list = set()
     GoAgentProxy.google_ip_failed_times = {}
     GoAgentProxy.google_ip_latency_records = {}
-    stat.counters = []
\ No newline at end of file
+    stat.clear()
\ No newline at end of file
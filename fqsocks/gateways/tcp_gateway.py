@@ -1,4 +1,5 @@
 import logging
+import time
 import gevent.server
 from .. import networking
 from .proxy_client import ProxyClient
@@ -12,9 +13,11 @@ server_greenlet = None
 
 def handle(downstream_sock, address):
     src_ip, src_port = address
+    accepted_at = time.time()
     try:
         dst_ip, dst_port = networking.get_original_destination(downstream_sock, src_ip, src_port)
-        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port)
+        client = ProxyClient(downstream_sock, src_ip, src_port, dst_ip, dst_port, gateway='tcp')
+        client.stage_done('original_dst', started_at=accepted_at)
         handle_client(client)
     except:
         LOGGER.exception('failed to handle %s:%s' % (src_ip, src_port))
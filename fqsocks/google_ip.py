@@ -0,0 +1,26 @@
+import china_ip
+
+# published netblocks of google services (not google cloud customers)
+GOOGLE_NETWORKS = [
+    china_ip.translate_ip_range('8.8.4.0', 24),
+    china_ip.translate_ip_range('8.8.8.0', 24),
+    china_ip.translate_ip_range('64.233.160.0', 19),
+    china_ip.translate_ip_range('66.102.0.0', 20),
+    china_ip.translate_ip_range('66.249.64.0', 19),
+    china_ip.translate_ip_range('72.14.192.0', 18),
+    china_ip.translate_ip_range('74.125.0.0', 16),
+    china_ip.translate_ip_range('108.177.0.0', 17),
+    china_ip.translate_ip_range('142.250.0.0', 15),
+    china_ip.translate_ip_range('172.217.0.0', 16),
+    china_ip.translate_ip_range('172.253.0.0', 16),
+    china_ip.translate_ip_range('173.194.0.0', 16),
+    china_ip.translate_ip_range('192.178.0.0', 15),
+    china_ip.translate_ip_range('203.208.32.0', 19),
+    china_ip.translate_ip_range('209.85.128.0', 17),
+    china_ip.translate_ip_range('216.58.192.0', 19),
+    china_ip.translate_ip_range('216.239.32.0', 19)]
+GOOGLE_IP_INDEX = china_ip.build_ip_range_index(GOOGLE_NETWORKS)
+
+
+def is_google_ip(ip):
+    return china_ip.ip_to_int(ip) in GOOGLE_IP_INDEX
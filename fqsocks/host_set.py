@@ -0,0 +1,136 @@
+import fnmatch
+import logging
+import sys
+
+LOGGER = logging.getLogger(__name__)
+
+HOST_SETS = {} # name => patterns
+HOST_SET_FILES = {} # name => file, patterns added to the registered host set of the same name
+MAX_MEMOIZED_HOSTS = 4096
+index = None
+memoized = {} # host => names of matched host sets
+
+
+class Node(object):
+    __slots__ = ('children', 'glob_children', 'exact', 'subdomains')
+
+    def __init__(self):
+        self.children = {} # label => node
+        self.glob_children = [] # (label pattern, node)
+        self.exact = frozenset() # host sets having a pattern ending at this label
+        self.subdomains = frozenset() # host sets having *.pattern, which matches any deeper label
+
+
+class HostSetIndex(object):
+    # patterns are stored by reversed labels, www.google.com is com => google => www
+    # a leading * matches one or more labels, other labels can be globs like s* or smile-*
+    def __init__(self, host_sets):
+        self.root = Node()
+        for name, patterns in host_sets.items():
+            for pattern in patterns:
+                self.add(name, pattern)
+
+    def add(self, name, pattern):
+        labels = normalize_host(pattern).split('.')
+        node = self.root
+        for i, label in enumerate(reversed(labels)):
+            if '*' == label and i == len(labels) - 1:
+                node.subdomains = node.subdomains | frozenset([name])
+                return
+            if '*' in label or '?' in label or '[' in label:
+                for glob, child in node.glob_children:
+                    if glob == label:
+                        break
+                else:
+                    child = Node()
+                    node.glob_children.append((label, child))
+            else:
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = Node()
+            node = child
+        node.exact = node.exact | frozenset([name])
+
+    def lookup(self, host):
+        labels = normalize_host(host).split('.')
+        labels.reverse()
+        return frozenset(self._lookup(self.root, labels, 0))
+
+    def _lookup(self, node, labels, i):
+        if i == len(labels):
+            return node.exact
+        matched = node.subdomains
+        child = node.children.get(labels[i])
+        if child is not None:
+            matched = matched | self._lookup(child, labels, i + 1)
+        for glob, child in node.glob_children:
+            if fnmatch.fnmatchcase(labels[i], glob):
+                matched = matched | self._lookup(child, labels, i + 1)
+        return matched
+
+    def memory_size(self):
+        size = 0
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            size += sys.getsizeof(node) + sys.getsizeof(node.children) + sys.getsizeof(node.glob_children)
+            for label, child in node.children.items():
+                size += sys.getsizeof(label)
+                nodes.append(child)
+            for glob, child in node.glob_children:
+                size += sys.getsizeof(glob)
+                nodes.append(child)
+        return size
+
+
+def load_host_set_file(file_path):
+    # one pattern per line, like www.google.com or *.google.com, lines starting with # are ignored
+    with open(file_path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                yield line
+
+
+def normalize_host(host):
+    return host.split(':')[0].rstrip('.').lower()
+
+
+def register(name, patterns):
+    global index
+    HOST_SETS[name] = patterns
+    index = None
+    memoized.clear()
+
+
+def build_index():
+    # patterns loaded from files are added to the registered ones of the same name
+    host_sets = {name: set(patterns) for name, patterns in HOST_SETS.items()}
+    for name, file_path in HOST_SET_FILES.items():
+        host_sets.setdefault(name, set()).update(load_host_set_file(file_path))
+    return HostSetIndex(host_sets)
+
+
+def swap_index(new_index):
+    global index
+    global memoized
+    index, memoized = new_index, {}
+
+
+def lookup(host):
+    global index
+    if not host:
+        return frozenset()
+    matched = memoized.get(host)
+    if matched is None:
+        if index is None:
+            index = build_index()
+        matched = index.lookup(host)
+        if len(memoized) >= MAX_MEMOIZED_HOSTS:
+            memoized.clear()
+        memoized[host] = matched
+    return matched
+
+
+def is_in(host, name):
+    return name in lookup(host)
@@ -0,0 +1,98 @@
+import logging
+import sys
+import time
+import traceback
+import collections
+
+import gevent
+import gevent.monkey
+import greenlet
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+BLOCKED_THRESHOLD = 0.1 # seconds one greenlet may hold the hub
+MAX_BLOCKED_RECORDS = 100
+
+start_new_thread = gevent.monkey.get_original('thread', 'start_new_thread')
+get_ident = gevent.monkey.get_original('thread', 'get_ident')
+real_sleep = gevent.monkey.get_original('time', 'sleep')
+
+blocked_records = collections.deque(maxlen=MAX_BLOCKED_RECORDS)
+monitor = None
+
+
+class HubMonitor(object):
+    # every greenlet switch is noted by a greenlet tracer. the probe greenlet wakes up twice per threshold,
+    # so the hub switches at least that often when nothing blocks it. an os thread of its own checks
+    # how long ago the last switch was, and takes the stack of the hub thread once it is over the threshold
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.thread_id = get_ident()
+        self.switched_at = time.time()
+        self.switches_count = 0
+        self.running = None # greenlet switched to last
+        self.blocked_record = None # of the switch being blocked, completed on the next switch
+        self.completed_records = [] # logged by the probe, the tracer and the watching thread do not log
+        self.previous_tracer = None
+
+    def start(self):
+        self.previous_tracer = greenlet.settrace(self.on_switch)
+        gevent.spawn(self.probe_forever)
+        start_new_thread(self.watch_forever, ())
+
+    def on_switch(self, event, args):
+        now = time.time()
+        if self.blocked_record is not None:
+            self.blocked_record['seconds'] = now - self.switched_at
+            metrics.hub_blocked.observe(self.blocked_record['seconds'])
+            self.completed_records.append(self.blocked_record)
+            self.blocked_record = None
+        self.switched_at = now
+        self.switches_count += 1
+        if event in ('switch', 'throw'):
+            self.running = args[1]
+        if self.previous_tracer is not None:
+            self.previous_tracer(event, args)
+
+    def probe_forever(self):
+        interval = self.threshold / 2
+        while True:
+            slept_at = time.time()
+            gevent.sleep(interval)
+            metrics.hub_lag.observe(max(time.time() - slept_at - interval, 0))
+            while self.completed_records:
+                record = self.completed_records.pop(0)
+                LOGGER.error('hub blocked for %0.3f seconds by %s:\n%s' % (
+                    record['seconds'], record['greenlet'], ''.join(record['stack'])))
+
+    def watch_forever(self):
+        reported_switches_count = None
+        while True:
+            real_sleep(self.threshold / 2)
+            try:
+                switches_count = self.switches_count
+                held_seconds = time.time() - self.switched_at
+                if held_seconds < self.threshold or switches_count == reported_switches_count:
+                    continue
+                reported_switches_count = switches_count
+                frame = sys._current_frames().get(self.thread_id)
+                record = {
+                    'blocked_at': self.switched_at,
+                    'seconds': held_seconds, # so far, the full time once the hub switches again
+                    'greenlet': repr(self.running),
+                    'stack': traceback.format_stack(frame) if frame else []
+                }
+                blocked_records.append(record)
+                if switches_count == self.switches_count:
+                    self.blocked_record = record
+            except:
+                LOGGER.exception('failed to watch hub')
+
+
+def start(threshold=BLOCKED_THRESHOLD):
+    global monitor
+    if monitor is None:
+        monitor = HubMonitor(threshold)
+        monitor.start()
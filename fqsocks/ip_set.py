@@ -0,0 +1,91 @@
+import array
+import bisect
+import logging
+import socket
+import struct
+
+import china_ip
+import lan_ip
+import google_ip
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_ip_set_file(file_path):
+    # one entry per line: 1.2.3.4, 1.2.3.0/24 or 1.2.3.4-1.2.3.9, lines starting with # are ignored
+    with open(file_path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            yield parse_ip_range(line)
+
+
+def parse_ip_range(text):
+    if '/' in text:
+        ip, netmask = text.split('/')
+        netmask = int(netmask)
+        start_ip_as_int = china_ip.ip_to_int(ip) & ((0xffffffff << (32 - netmask)) & 0xffffffff)
+        return start_ip_as_int, start_ip_as_int + (1 << (32 - netmask)) - 1
+    if '-' in text:
+        start_ip, end_ip = text.split('-')
+        return china_ip.ip_to_int(start_ip.strip()), china_ip.ip_to_int(end_ip.strip())
+    ip_as_int = china_ip.ip_to_int(text)
+    return ip_as_int, ip_as_int
+
+
+class IpSetIndex(object):
+    # all named sets flattened into disjoint intervals, each interval knows every set covering it,
+    # so one bisect answers which sets an ip belongs to no matter how many sets are loaded
+    def __init__(self, named_ip_ranges):
+        boundaries = {}
+        for name, ip_ranges in named_ip_ranges.items():
+            for start_ip_as_int, end_ip_as_int in ip_ranges:
+                boundaries.setdefault(start_ip_as_int, []).append((name, 1))
+                if end_ip_as_int < 0xffffffff:
+                    boundaries.setdefault(end_ip_as_int + 1, []).append((name, -1))
+        self.names = frozenset(named_ip_ranges)
+        self.starts = array.array('I', [0])
+        self.ip_sets = [frozenset()]
+        interned = {frozenset(): self.ip_sets[0]}
+        depth = {}
+        for boundary in sorted(boundaries):
+            for name, delta in boundaries[boundary]:
+                depth[name] = depth.get(name, 0) + delta
+            ip_sets = frozenset(name for name, count in depth.items() if count > 0)
+            ip_sets = interned.setdefault(ip_sets, ip_sets)
+            if ip_sets is self.ip_sets[-1]:
+                continue
+            if boundary == self.starts[-1]:
+                self.ip_sets[-1] = ip_sets
+            else:
+                self.starts.append(boundary)
+                self.ip_sets.append(ip_sets)
+
+    def lookup(self, ip_as_int):
+        return self.ip_sets[bisect.bisect_right(self.starts, ip_as_int) - 1]
+
+    def lookup_packed(self, packed_ip):
+        return self.lookup(struct.unpack('!I', packed_ip)[0])
+
+    def lookup_ip(self, ip):
+        return self.lookup_packed(socket.inet_aton(ip))
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def builtin_ip_sets():
+    return {
+        'china': china_ip.CHINA_IP_INDEX,
+        'lan': lan_ip.LAN_IP_INDEX,
+        'google': google_ip.GOOGLE_IP_INDEX
+    }
+
+
+def build_ip_set_index(ip_set_files=None):
+    named_ip_ranges = builtin_ip_sets()
+    for name, file_path in (ip_set_files or {}).items():
+        named_ip_ranges[name] = list(load_ip_set_file(file_path))
+        LOGGER.info('loaded ip set %s from %s: %s ranges' % (name, file_path, len(named_ip_ranges[name])))
+    return IpSetIndex(named_ip_ranges)
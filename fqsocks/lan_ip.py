@@ -9,6 +9,7 @@ LOCAL_NETWORKS = [
     china_ip.translate_ip_range('192.168.0.0', 16),
     china_ip.translate_ip_range('224.0.0.0', 4),
     china_ip.translate_ip_range('240.0.0.0', 4)]
+LAN_IP_INDEX = china_ip.build_ip_range_index(LOCAL_NETWORKS)
 
 
 def is_lan_traffic(src, dst):
@@ -18,5 +19,8 @@ def is_lan_traffic(src, dst):
 
 
 def is_lan_ip(ip):
-    ip_as_int = china_ip.ip_to_int(ip)
-    return any(start_ip_as_int <= ip_as_int <= end_ip_as_int for start_ip_as_int, end_ip_as_int in LOCAL_NETWORKS)
\ No newline at end of file
+    return china_ip.ip_to_int(ip) in LAN_IP_INDEX
+
+
+def are_lan_ips(ips):
+    return china_ip.classify_ips(ips, LAN_IP_INDEX)
@@ -0,0 +1,215 @@
+import logging
+import bisect
+
+LOGGER = logging.getLogger(__name__)
+
+LATENCY_BOUNDS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+HUB_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5) # seconds
+MAX_FALL_BACK_REASONS = 64 # reasons often carry a host or an error message, the rest are counted as other
+SUB_BUCKET_BITS = 4 # each power of two is split into 16 buckets, values are off by at most 1/16
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+connections_active = {} # (gateway, proxy type) => count
+connections_total = {} # (gateway, proxy type) => count
+fall_backs = {} # (proxy type, reason) => count
+fall_back_reasons = set()
+proxy_transitions = {} # (proxy, died or revived) => count
+latency_histograms = {} # proxy => Histogram
+stage_histograms = {} # (proxy type, stage) => LogLinearHistogram
+
+
+class Histogram(object):
+    # counts go into the first bucket whose upper bound is not below the value, the last bucket is +Inf
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LogLinearHistogram(object):
+    # microseconds go into buckets growing by powers of two, each split linearly into SUB_BUCKETS.
+    # observing is a bit_length and a shift, the counts stay a few hundred ints even for hours
+    def __init__(self):
+        self.counts = []
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        if value < SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.sum += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper_bound(index) / 1000000.0, self.max)
+        return self.max
+
+    def describe(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': [(bucket_upper_bound(index) / 1000000.0, count)
+                        for index, count in enumerate(self.counts) if count]
+        }
+
+
+def bucket_upper_bound(index):
+    if index < SUB_BUCKETS:
+        return index + 1
+    shift = index / SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift
+
+
+hub_lag = Histogram(HUB_BOUNDS) # how late the hub monitor probe wakes up
+hub_blocked = Histogram(HUB_BOUNDS) # how long the hub was held over the threshold
+
+
+def proxy_type(proxy):
+    return proxy.__class__.__name__
+
+
+def proxy_name(proxy):
+    return (proxy.public_name or repr(proxy)).replace('\t', ' ')
+
+
+def forward_started(client, proxy):
+    key = (client.gateway, proxy_type(proxy))
+    connections_active[key] = connections_active.get(key, 0) + 1
+    connections_total[key] = connections_total.get(key, 0) + 1
+
+
+def forward_ended(client, proxy):
+    key = (client.gateway, proxy_type(proxy))
+    connections_active[key] -= 1
+
+
+def fell_back(proxy, reason):
+    if reason not in fall_back_reasons:
+        if len(fall_back_reasons) >= MAX_FALL_BACK_REASONS:
+            reason = 'other'
+        else:
+            fall_back_reasons.add(reason)
+    key = (proxy_type(proxy) if proxy else 'None', reason)
+    fall_backs[key] = fall_backs.get(key, 0) + 1
+
+
+def proxy_died_changed(proxy, died):
+    key = (proxy_name(proxy), 'died' if died else 'revived')
+    proxy_transitions[key] = proxy_transitions.get(key, 0) + 1
+
+
+def latency_recorded(proxy, latency):
+    name = proxy_name(proxy)
+    histogram = latency_histograms.get(name)
+    if histogram is None:
+        histogram = latency_histograms[name] = Histogram(LATENCY_BOUNDS)
+    histogram.observe(latency)
+
+
+def stages_done(proxy, stages):
+    # stages done before any proxy was picked count for the proxy finally forwarding the connection
+    for stage, seconds, stage_proxy in stages:
+        key = (proxy_type(stage_proxy or proxy) if stage_proxy or proxy else 'None', stage)
+        histogram = stage_histograms.get(key)
+        if histogram is None:
+            histogram = stage_histograms[key] = LogLinearHistogram()
+        histogram.observe(seconds)
+
+
+def describe_stages():
+    stages = {}
+    for (stage_proxy_type, stage), histogram in stage_histograms.items():
+        stages.setdefault(stage_proxy_type, {})[stage] = histogram.describe()
+    return stages
+
+
+def render(proxy_traffics):
+    # text exposition format, one sample per line. only walks what has been counted, so cheap to scrape often
+    lines = []
+    add_family(lines, 'fqsocks_connections_active', 'gauge', 'connections being forwarded',
+               connections_active, ('gateway', 'proxy_type'))
+    add_family(lines, 'fqsocks_connections_total', 'counter', 'connections forwarded',
+               connections_total, ('gateway', 'proxy_type'))
+    add_family(lines, 'fqsocks_proxy_rx_bytes_total', 'counter', 'bytes received from upstream',
+               {(name.replace('\t', ' '),): traffic.lifetime_rx_bytes for name, traffic in proxy_traffics.items()},
+               ('proxy',))
+    add_family(lines, 'fqsocks_proxy_tx_bytes_total', 'counter', 'bytes sent to upstream',
+               {(name.replace('\t', ' '),): traffic.lifetime_tx_bytes for name, traffic in proxy_traffics.items()},
+               ('proxy',))
+    add_family(lines, 'fqsocks_fall_backs_total', 'counter', 'proxy fall backs',
+               fall_backs, ('proxy_type', 'reason'))
+    add_family(lines, 'fqsocks_proxy_transitions_total', 'counter', 'proxy died or revived',
+               proxy_transitions, ('proxy', 'transition'))
+    add_histograms(lines, 'fqsocks_proxy_latency_seconds', 'proxy connect latency',
+                   latency_histograms, 'proxy')
+    add_histograms(lines, 'fqsocks_hub_lag_seconds', 'how late the hub monitor probe woke up',
+                   {'hub': hub_lag}, 'loop')
+    add_histograms(lines, 'fqsocks_hub_blocked_seconds', 'how long one greenlet held the hub over the threshold',
+                   {'hub': hub_blocked}, 'loop')
+    return '\n'.join(lines) + '\n'
+
+
+def add_family(lines, name, type, help, samples, label_names):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, type))
+    for label_values, value in sorted(samples.items()):
+        lines.append('%s{%s} %s' % (name, format_labels(zip(label_names, label_values)), format_value(value)))
+
+
+def add_histograms(lines, name, help, histograms, label_name):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s histogram' % name)
+    for label_value, histogram in sorted(histograms.items()):
+        cumulative_count = 0
+        for bound, count in zip(list(histogram.bounds) + ['+Inf'], histogram.counts):
+            cumulative_count += count
+            lines.append('%s_bucket{%s} %s' % (
+                name, format_labels([(label_name, label_value), ('le', format_value(bound))]), cumulative_count))
+        lines.append('%s_sum{%s} %s' % (name, format_labels([(label_name, label_value)]), format_value(histogram.sum)))
+        lines.append('%s_count{%s} %s' % (name, format_labels([(label_name, label_value)]), histogram.count))
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (label_name, escape_label_value(label_value)) for label_name, label_value in labels)
+
+
+def escape_label_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
@@ -5,14 +5,42 @@ import logging
 import random
 import contextlib
 import gevent
+import gevent.socket
+import gevent.event
 import sys
 import re
+import os
+import errno
+import ctypes
 
 LOGGER = logging.getLogger(__name__)
 SO_ORIGINAL_DST = 80
 OUTBOUND_IP = None
 SPI = {}
 RE_IP = re.compile(r'^\d+\.\d+\.\d+\.\d+$')
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_MAX_LEN = 64 * 1024 # default pipe capacity
+MAX_POOLED_PIPES = 8
+MIN_BUFFER_SIZE = 8 * 1024
+MAX_POOLED_BUFFER_BYTES = 4 * 1024 * 1024
+CONNECTION_CLOSED_ERRORS = (10053, 10054, 10057, errno.EPIPE)
+
+
+def load_splice():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        splice = libc.splice
+    except:
+        return None
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+    return splice
+
+
+_splice = load_splice()
 
 
 def create_tcp_socket(server_ip, server_port, connect_timeout):
@@ -75,4 +103,336 @@ def resolve_ips(host):
             else:
                 LOGGER.info('failed to resolve %s: %s' % (host, sys.exc_info()[1]), exc_info=1)
         gevent.sleep(1)
-    return []
\ No newline at end of file
+    return []
+
+
+def is_splice_supported(*socks):
+    return bool(_splice) and is_plain_socket(*socks)
+
+
+def is_plain_socket(*socks):
+    # kernel sockets only, not ssl sockets or paramiko channels
+    for sock in socks:
+        if type(sock) is not socket.socket:
+            return False
+    return True
+
+
+class SplicePipe(object):
+    # moves bytes between two sockets through a kernel pipe, they never get copied into python strings
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class SplicePipePool(object):
+    # pipes are borrowed only while bytes are moving, so idle connections hold no pipe fds.
+    # at most max_pooled_pipes empty pipes are kept for reuse, the rest are closed
+    def __init__(self, max_pooled_pipes):
+        self.max_pooled_pipes = max_pooled_pipes
+        self.free_pipes = []
+
+    def acquire(self):
+        if self.free_pipes:
+            return self.free_pipes.pop()
+        return SplicePipe()
+
+    def release(self, pipe):
+        if len(self.free_pipes) < self.max_pooled_pipes:
+            self.free_pipes.append(pipe)
+        else:
+            pipe.close()
+
+
+PIPE_POOL = SplicePipePool(MAX_POOLED_PIPES)
+
+
+def splice_transfer(from_sock, to_sock, max_len=SPLICE_MAX_LEN, bulk=False, on_received=None):
+    # returns bytes moved, 0 means from_sock reached eof
+    # the pipe goes back to the pool drained before waiting for from_sock again,
+    # a pipe which might still hold bytes (writing to to_sock failed) is closed instead
+    # bulk: to_sock is corked and flushed before waiting for from_sock
+    # on_received: called with the bytes read from from_sock before any of them is written to to_sock
+    from_fd = from_sock.fileno()
+    to_fd = to_sock.fileno()
+    while True:
+        pipe = PIPE_POOL.acquire()
+        try:
+            moved = splice(from_fd, pipe.write_fd, min(max_len, SPLICE_MAX_LEN))
+        except:
+            PIPE_POOL.release(pipe)
+            raise
+        if moved is not None:
+            break
+        PIPE_POOL.release(pipe)
+        if bulk:
+            flush_cork(to_sock)
+        gevent.socket.wait_read(from_fd, timeout=from_sock.gettimeout(), timeout_exc=socket.timeout('timed out'))
+    try:
+        if on_received:
+            on_received(moved)
+        pending = moved
+        while pending:
+            written = splice(pipe.read_fd, to_fd, pending)
+            if written is None:
+                gevent.socket.wait_write(to_fd, timeout=to_sock.gettimeout(), timeout_exc=socket.timeout('timed out'))
+            else:
+                pending -= written
+    except:
+        pipe.close()
+        raise
+    PIPE_POOL.release(pipe)
+    return moved
+
+
+def splice(from_fd, to_fd, length):
+    # returns None if it would block
+    moved = _splice(from_fd, None, to_fd, None, length, SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+    if moved < 0:
+        error_number = ctypes.get_errno()
+        if error_number in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        if errno.EINTR == error_number:
+            return splice(from_fd, to_fd, length)
+        raise socket.error(error_number, os.strerror(error_number))
+    return moved
+
+
+class BufferPool(object):
+    # bytearrays reused by the forward loops, sizes are rounded up to power of two,
+    # at most max_pooled_bytes are kept for reuse, the rest is left to be garbage collected
+    def __init__(self, max_pooled_bytes):
+        self.max_pooled_bytes = max_pooled_bytes
+        self.pooled_bytes = 0
+        self.free_buffers = {} # size => [bytearray]
+
+    def acquire(self, min_size):
+        size = MIN_BUFFER_SIZE
+        while size < min_size:
+            size *= 2
+        buffers = self.free_buffers.get(size)
+        if buffers:
+            self.pooled_bytes -= size
+            return buffers.pop()
+        return bytearray(size)
+
+    def release(self, buffer):
+        size = len(buffer)
+        if self.pooled_bytes + size > self.max_pooled_bytes:
+            return
+        self.pooled_bytes += size
+        self.free_buffers.setdefault(size, []).append(buffer)
+
+
+BUFFER_POOL = BufferPool(MAX_POOLED_BUFFER_BYTES)
+
+
+def relay_through_buffer(from_sock, to_sock, max_len, bulk=False, on_received=None):
+    # returns bytes relayed, 0 means from_sock reached eof
+    # on_received: called with the bytes read from from_sock before any of them is sent to to_sock
+    # the buffer is borrowed only once there is something to read, so idle connections hold none
+    # bulk: whatever else is ready (at most max_len in flight) goes out in the same send,
+    # to_sock is expected to be corked and is flushed once from_sock has nothing more to give
+    wait_readable(from_sock)
+    buffer = BUFFER_POOL.acquire(max_len)
+    try:
+        view = memoryview(buffer)
+        received = from_sock.recv_into(view, max_len)
+        drained = True
+        if bulk and received:
+            while received < max_len:
+                more = recv_ready_into(from_sock, view[received:max_len])
+                if not more:
+                    break
+                received += more
+            else:
+                drained = False
+        if on_received:
+            on_received(received)
+        sent = 0
+        while sent < received:
+            sent += to_sock.send(view[sent:received])
+        if bulk and drained:
+            flush_cork(to_sock)
+        return received
+    finally:
+        BUFFER_POOL.release(buffer)
+
+
+def recv_ready_into(sock, view):
+    # returns 0 if nothing is ready, eof is left to the next blocking recv
+    if getattr(sock, 'pending', None): # ssl socket
+        return sock.recv_into(view) if sock.pending() else 0
+    try:
+        return sock._sock.recv_into(view)
+    except socket.error as e:
+        if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
+
+
+def shutdown_write(sock):
+    # returns False if sock can not be half closed, ssl sockets lose their ssl state on shutdown
+    if hasattr(sock, 'shutdown_write'): # paramiko channel
+        sock.shutdown_write()
+        return True
+    if not is_plain_socket(sock):
+        return False
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        return True
+    except socket.error:
+        return False
+
+
+def set_nodelay(sock):
+    # interactive flows, every small write goes out at once
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (AttributeError, socket.error):
+        pass
+
+
+def set_cork(sock, enabled):
+    # bulk flows, only full segments go out until the cork is removed, returns False if not supported
+    if not hasattr(socket, 'TCP_CORK') or not is_plain_socket(sock):
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enabled else 0)
+        return True
+    except socket.error:
+        return False
+
+
+def flush_cork(sock):
+    set_cork(sock, False)
+    set_cork(sock, True)
+
+
+def wait_readable(sock):
+    if getattr(sock, 'pending', None) and sock.pending(): # ssl socket has decrypted bytes already
+        return
+    gevent.socket.wait_read(sock.fileno(), timeout=sock.gettimeout(), timeout_exc=socket.timeout('timed out'))
+
+
+class EventDrivenRelay(object):
+    # both directions are relayed from io watcher callbacks running in the hub, so an idle connection
+    # costs two watchers and the calling greenlet parked in run, instead of two greenlets each blocked on a read,
+    # a greenlet is spawned only to finish a send the receiving side is not ready to take,
+    # and to run the first byte and downstream eof callbacks, which might log or switch, neither allowed in the hub.
+    # on_received and on_sending are only counting, they run in the hub.
+    # timeouts are left to the caller, which ends the relay by finish(socket.timeout(...))
+    def __init__(self, upstream_sock, downstream_sock, bufsize, on_received, on_sending, on_first_byte_received,
+                 on_downstream_eof):
+        self.loop = gevent.get_hub().loop
+        self.upstream_sock = upstream_sock
+        self.on_first_byte_received = on_first_byte_received
+        self.on_downstream_eof = on_downstream_eof # returns True if upstream was half closed
+        self.first_byte_received = False
+        self.deferred = [] # greenlets running callbacks, joined before run returns
+        self.finished = gevent.event.AsyncResult()
+        self.directions = [
+            RelayDirection(self.loop, upstream_sock, downstream_sock, bufsize * 16, on_received),
+            RelayDirection(self.loop, downstream_sock, upstream_sock, bufsize, on_sending)]
+
+    def run(self):
+        # returns the error ending the relay, None if either side closed normally
+        for direction in self.directions:
+            direction.watcher.start(self.on_readable, direction)
+        try:
+            return self.finished.get()
+        finally:
+            self.close()
+            gevent.joinall(self.deferred) # the caller checks what the first byte callback did
+
+    def on_readable(self, direction):
+        try:
+            buffer = BUFFER_POOL.acquire(direction.max_len)
+            try:
+                received = direction.from_sock._sock.recv_into(buffer, direction.max_len)
+                if received:
+                    if direction.from_sock is self.upstream_sock and not self.first_byte_received:
+                        self.first_byte_received = True # before the send, which might find downstream gone
+                        self.defer(self.on_first_byte_received)
+                    view = memoryview(buffer)
+                    sent = send_without_blocking(direction.to_sock, view[:received])
+                    if sent < received:
+                        direction.watcher.stop()
+                        direction.sender = gevent.spawn(self.send_pending, direction, view[sent:received].tobytes())
+            finally:
+                BUFFER_POOL.release(buffer)
+        except socket.error as e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            return self.finish(None if e[0] in CONNECTION_CLOSED_ERRORS else e)
+        except:
+            LOGGER.exception('event driven relay failed')
+            return self.finish(sys.exc_info()[1])
+        if not received:
+            if direction.from_sock is self.upstream_sock:
+                return self.finish(None)
+            direction.watcher.stop()
+            self.defer(self.on_downstream_eof_deferred)
+            return
+        direction.on_relayed(received)
+
+    def on_downstream_eof_deferred(self):
+        if not self.on_downstream_eof():
+            self.finish(None)
+        # otherwise upstream keeps relaying its response
+
+    def defer(self, callback):
+        self.deferred.append(gevent.spawn(self.run_deferred, callback))
+
+    def run_deferred(self, callback):
+        try:
+            callback()
+        except:
+            LOGGER.exception('event driven relay failed')
+            self.finish(sys.exc_info()[1])
+
+    def send_pending(self, direction, data):
+        try:
+            direction.to_sock.sendall(data)
+        except socket.error as e:
+            return self.finish(None if e[0] in CONNECTION_CLOSED_ERRORS else e)
+        except gevent.GreenletExit:
+            return
+        except:
+            LOGGER.exception('event driven relay failed')
+            return self.finish(sys.exc_info()[1])
+        direction.sender = None
+        if not self.finished.ready():
+            direction.watcher.start(self.on_readable, direction)
+
+    def finish(self, error):
+        if not self.finished.ready():
+            self.finished.set(error)
+
+    def close(self):
+        for direction in self.directions:
+            direction.watcher.stop()
+            if direction.sender:
+                direction.sender.kill(block=False)
+
+
+class RelayDirection(object):
+    def __init__(self, loop, from_sock, to_sock, max_len, on_relayed):
+        self.from_sock = from_sock
+        self.to_sock = to_sock
+        self.max_len = max_len
+        self.on_relayed = on_relayed
+        self.watcher = loop.io(from_sock.fileno(), 1)
+        self.sender = None
+
+
+def send_without_blocking(sock, data):
+    try:
+        return sock._sock.send(data)
+    except socket.error as e:
+        if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
@@ -4,43 +4,142 @@ import logging.handlers
 import argparse
 import sys
 import socket
-import china_ip
-
-import dpkt
+import time
+import os
+import signal
+import threading
+import ip_set
 
 
 LOGGER = logging.getLogger('nfqueue-ipset')
 
 RULES = []
+IP_SET_INDEX = None
+IP_SET_RELOADER = None
+VERDICT_CACHE = None
+STATS_INTERVAL = 60
+QUEUE_NUMBER = None
+WORKER_RESTART_INTERVAL = 1
+IP_SET_CHECK_INTERVAL = 10
+LOG_FILE = None
+LOG_FILE_HANDLER = None
 
 
 def main():
     global DEFAULT_VERDICT
+    global IP_SET_INDEX
+    global IP_SET_RELOADER
+    global VERDICT_CACHE
+    global LOG_FILE
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument('--log-file')
     argument_parser.add_argument('--log-level', choices=['INFO', 'DEBUG'], default='INFO')
     argument_parser.add_argument('--queue-number', default=0, type=int)
     argument_parser.add_argument(
-        '--rule', default=[], action='append', help='direction,ip_set_name,verdict, for example dst,china,0xfeed1')
+        '--queues', help='for example 0-3 or 0,2, fork one worker process per queue, '
+                         'use with iptables -j NFQUEUE --queue-balance 0:3')
+    argument_parser.add_argument(
+        '--ip-set', default=[], action='append',
+        help='ip_set_name=file, one ip, cidr or ip range per line, reloaded on change, '
+             'for example bypass=/data/bypass.txt')
+    argument_parser.add_argument(
+        '--rule', default=[], action='append',
+        help='direction,ip_set_name,verdict, for example dst,china,0xfeed1. built-in ip sets: china, lan, google')
     argument_parser.add_argument('--default', default='ACCEPT', help='if no rule matched')
+    argument_parser.add_argument(
+        '--verdict-cache-size', default=65536, type=int, help='(src, dst) pairs to remember, 0 to disable')
     args = argument_parser.parse_args()
     log_level = getattr(logging, args.log_level)
     logging.basicConfig(stream=sys.stdout, level=log_level, format='%(asctime)s %(levelname)s %(message)s')
-    if args.log_file:
-        handler = logging.handlers.RotatingFileHandler(
-            args.log_file, maxBytes=1024 * 16, backupCount=0)
-        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-        handler.setLevel(log_level)
-        logging.getLogger('nfqueue-ipset').addHandler(handler)
+    LOG_FILE = args.log_file
+    if LOG_FILE:
+        setup_log_file(LOG_FILE, log_level)
+    ip_set_files = dict(input.split('=', 1) for input in args.ip_set)
+    IP_SET_INDEX = ip_set.build_ip_set_index(ip_set_files)
+    IP_SET_RELOADER = IpSetReloader(ip_set_files)
+    VERDICT_CACHE = VerdictCache(args.verdict_cache_size)
     for input in args.rule:
         RULES.append(Rule.parse(input))
-    Rule.DEFAULT_VERDICT = Rule.parse_verdict(args.default)
-    Rule.MATCHED_DEFAULT = 'default,%s,%s => ' + args.default
-    handle_nfqueue(args.queue_number)
+    Rule.DEFAULT = DefaultRule(args.default)
+    if args.queues:
+        supervise_workers(parse_queue_numbers(args.queues))
+    else:
+        handle_nfqueue(args.queue_number)
+
+
+def setup_log_file(log_file, log_level):
+    global LOG_FILE_HANDLER
+    if LOG_FILE_HANDLER:
+        LOGGER.removeHandler(LOG_FILE_HANDLER)
+        LOG_FILE_HANDLER.close()
+    LOG_FILE_HANDLER = logging.handlers.RotatingFileHandler(log_file, maxBytes=1024 * 16, backupCount=0)
+    LOG_FILE_HANDLER.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    LOG_FILE_HANDLER.setLevel(log_level)
+    LOGGER.addHandler(LOG_FILE_HANDLER)
+
+
+def parse_queue_numbers(queues):
+    queue_numbers = []
+    for part in queues.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            queue_numbers.extend(range(int(first), int(last) + 1))
+        else:
+            queue_numbers.append(int(part))
+    return queue_numbers
+
+
+def supervise_workers(queue_numbers):
+    # ip sets are loaded before forking, so the workers start with the index pages of the supervisor.
+    # they are shared copy on write, reference counting makes a worker copy the pages it touches
+    workers = {} # pid => (queue_number, started_at)
+
+    def stop_workers(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    for queue_number in queue_numbers:
+        workers[fork_worker(queue_number)] = (queue_number, time.time())
+    try:
+        while workers:
+            pid, status = os.wait()
+            if pid not in workers:
+                continue
+            queue_number, started_at = workers.pop(pid)
+            LOGGER.error('worker %s of queue number %s exited with status %s' % (pid, queue_number, status))
+            if time.time() - started_at < WORKER_RESTART_INTERVAL:
+                time.sleep(WORKER_RESTART_INTERVAL)
+            workers[fork_worker(queue_number)] = (queue_number, time.time())
+    except KeyboardInterrupt:
+        stop_workers(None, None)
+
+
+def fork_worker(queue_number):
+    pid = os.fork()
+    if pid:
+        LOGGER.info('forked worker %s for queue number %s' % (pid, queue_number))
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if LOG_FILE:
+        # rollovers of one file by many processes would interleave and lose lines
+        setup_log_file('%s.%s' % (LOG_FILE, queue_number), LOG_FILE_HANDLER.level)
+    try:
+        handle_nfqueue(queue_number)
+    except:
+        LOGGER.exception('worker of queue number %s failed' % queue_number)
+    finally:
+        os._exit(1)
 
 
 def handle_nfqueue(queue_number):
+    global QUEUE_NUMBER
     from netfilterqueue import NetfilterQueue
+    QUEUE_NUMBER = queue_number
     while True:
         try:
             nfqueue = NetfilterQueue()
@@ -51,15 +150,23 @@ def handle_nfqueue(queue_number):
             LOGGER.exception('failed to handle nfqueue')
             return
         finally:
+            log_stats()
             LOGGER.info('stopped handling nfqueue')
 
 
 def handle_packet(nfqueue_element):
     try:
-        ip_packet = dpkt.ip.IP(nfqueue_element.get_payload())
-        src = socket.inet_ntoa(ip_packet.src)
-        dst = socket.inet_ntoa(ip_packet.dst)
-        verdict = Rule.get_verdict(src, dst)
+        payload = nfqueue_element.get_payload()
+        if len(payload) < 20 or 4 != ord(payload[0]) >> 4: # only ipv4 headers carry the addresses below
+            nfqueue_element.accept()
+            return
+        src_dst = payload[12:20] # only the addresses in the ipv4 header are needed
+        rule = VERDICT_CACHE.get(src_dst)
+        if rule is None:
+            rule = Rule.find_matched_rule(src_dst[:4], src_dst[4:])
+            VERDICT_CACHE.put(src_dst, rule)
+        rule.packets_count += 1
+        verdict = rule.verdict
         if 'ACCEPT' == verdict:
             nfqueue_element.accept()
         elif 'DROP' == verdict:
@@ -70,41 +177,154 @@ def handle_packet(nfqueue_element):
     except:
         LOGGER.exception('failed to handle packet')
         nfqueue_element.accept()
+    VERDICT_CACHE.packets_count += 1
+    if not VERDICT_CACHE.packets_count & 0xff:
+        now = time.time()
+        if now - VERDICT_CACHE.stats_logged_at > STATS_INTERVAL:
+            VERDICT_CACHE.stats_logged_at = now
+            log_stats()
+        if IP_SET_RELOADER:
+            IP_SET_RELOADER.check(now)
+
+
+def log_stats():
+    if VERDICT_CACHE is None:
+        return
+    LOGGER.info('queue number %s handled %s packets, verdict cache hits %s misses %s size %s' % (
+        QUEUE_NUMBER, VERDICT_CACHE.packets_count,
+        VERDICT_CACHE.hits_count, VERDICT_CACHE.misses_count, len(VERDICT_CACHE)))
+    for rule in RULES + [Rule.DEFAULT]:
+        LOGGER.info('%s => %s packets' % (rule, rule.packets_count))
+
+
+class IpSetReloader(object):
+    # ip set files changed are loaded into a new index by a thread of its own, packets keep being
+    # classified by the old index meanwhile. the swap and clearing the verdict cache happen
+    # in the packet handling thread, so no verdict of the old index is cached after the swap
+    def __init__(self, ip_set_files):
+        self.ip_set_files = ip_set_files
+        self.mtimes = self.get_mtimes()
+        self.checked_at = time.time()
+        self.thread = None
+        self.built_index = None
+        self.build_seconds = None
+
+    def check(self, now):
+        global IP_SET_INDEX
+        if self.built_index is not None:
+            IP_SET_INDEX, self.built_index = self.built_index, None
+            VERDICT_CACHE.clear()
+            LOGGER.info('reloaded ip sets in %0.3f seconds: %s intervals' % (self.build_seconds, len(IP_SET_INDEX)))
+        if now - self.checked_at < IP_SET_CHECK_INTERVAL or (self.thread and self.thread.is_alive()):
+            return
+        self.checked_at = now
+        mtimes = self.get_mtimes()
+        if mtimes == self.mtimes:
+            return
+        self.mtimes = mtimes
+        LOGGER.info('ip set files changed, reload: %s' % self.ip_set_files)
+        self.thread = threading.Thread(target=self.build)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def build(self):
+        try:
+            started_at = time.time()
+            built_index = ip_set.build_ip_set_index(self.ip_set_files)
+            self.build_seconds = time.time() - started_at
+            self.built_index = built_index
+        except:
+            LOGGER.exception('failed to reload ip sets, keep the old ones')
+
+    def get_mtimes(self):
+        mtimes = []
+        for name, file_path in sorted(self.ip_set_files.items()):
+            try:
+                mtimes.append(os.path.getmtime(file_path))
+            except OSError:
+                mtimes.append(0)
+        return mtimes
+
+
+class VerdictCache(object):
+    # approximate lru in two generations: a hit in the old generation is promoted to the young one,
+    # when the young generation is full it becomes the old one, so every operation is a dict lookup
+    def __init__(self, size):
+        self.generation_size = size // 2
+        self.young = {}
+        self.old = {}
+        self.packets_count = 0
+        self.hits_count = 0
+        self.misses_count = 0
+        self.stats_logged_at = time.time()
+
+    def get(self, key):
+        value = self.young.get(key)
+        if value is not None:
+            self.hits_count += 1
+            return value
+        value = self.old.get(key)
+        if value is not None:
+            self.hits_count += 1
+            self.put(key, value)
+            return value
+        self.misses_count += 1
+        return None
+
+    def put(self, key, value):
+        if not self.generation_size:
+            return
+        if len(self.young) >= self.generation_size:
+            self.old = self.young
+            self.young = {}
+        self.young[key] = value
+
+    def clear(self):
+        self.young = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
 
 
 class Rule(object):
-    DEFAULT_VERDICT = None
-    MATCHED_DEFAULT = None
+    DEFAULT = None
 
     def __init__(self, direction, ipset_name, verdict):
         super(Rule, self).__init__()
         self.direction = direction
         self.ipset_name = ipset_name
-        self.matched_src = 'src,%s => ' + verdict
-        self.matched_dst = 'dst,%s => ' + verdict
+        self.description = '%s,%s,%s' % (direction, ipset_name, verdict)
         self.verdict = Rule.parse_verdict(verdict)
-        assert self.ipset_name == 'china' # it is not a generic implementation yet
+        self.packets_count = 0
+        if self.ipset_name not in IP_SET_INDEX.names:
+            raise Exception('unknown ip set %s, known ip sets: %s' % (self.ipset_name, ', '.join(IP_SET_INDEX.names)))
         self.match = getattr(self, 'match_%s' % direction)
 
-    def match_src(self, src, dst):
-        matched = china_ip.is_china_ip(src)
-        if matched:
-            LOGGER.info(self.matched_src % src)
-        return matched
+    def match_src(self, src_ip_sets, dst_ip_sets):
+        return self.ipset_name in src_ip_sets
 
-    def match_dst(self, src, dst):
-        matched = china_ip.is_china_ip(dst)
-        if matched:
-            LOGGER.info(self.matched_dst % dst)
-        return matched
+    def match_dst(self, src_ip_sets, dst_ip_sets):
+        return self.ipset_name in dst_ip_sets
 
     @classmethod
-    def get_verdict(cls, src, dst):
+    def find_matched_rule(cls, src, dst):
+        # src and dst are packed 4 byte addresses, each is looked up once for all ip sets
+        src_ip_sets = IP_SET_INDEX.lookup_packed(src)
+        dst_ip_sets = IP_SET_INDEX.lookup_packed(dst)
         for rule in RULES:
-            if rule.match(src, dst):
-                return rule.verdict
-        LOGGER.info(Rule.MATCHED_DEFAULT % (src, dst))
-        return Rule.DEFAULT_VERDICT
+            if rule.match(src_ip_sets, dst_ip_sets):
+                matched_rule = rule
+                break
+        else:
+            matched_rule = Rule.DEFAULT
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('%s => %s matched %s' % (socket.inet_ntoa(src), socket.inet_ntoa(dst), matched_rule))
+        return matched_rule
+
+    @classmethod
+    def get_verdict(cls, src, dst):
+        return cls.find_matched_rule(src, dst).verdict
 
     @classmethod
     def parse_verdict(cls, verdict):
@@ -117,6 +337,20 @@ class Rule(object):
     def parse(cls, input):
         return Rule(*input.split(','))
 
+    def __str__(self):
+        return self.description
+
+
+class DefaultRule(object):
+    def __init__(self, verdict):
+        super(DefaultRule, self).__init__()
+        self.description = 'default,%s' % verdict
+        self.verdict = Rule.parse_verdict(verdict)
+        self.packets_count = 0
+
+    def __str__(self):
+        return self.description
+
 
 if '__main__' == __name__:
-    main()
\ No newline at end of file
+    main()
@@ -2,4 +2,8 @@ from . import downstream
 from . import assets
 from . import upstream
 from . import lan_device
-from . import home
\ No newline at end of file
+from . import home
+from . import reloadable_sets
+from . import connections
+from . import metrics
+from . import profile
\ No newline at end of file
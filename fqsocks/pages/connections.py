@@ -0,0 +1,40 @@
+import httplib
+import json
+import logging
+
+from .. import httpd
+from .. import timeouts
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@httpd.http_handler('GET', 'connections')
+def handle_list_connections(environ, start_response):
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps(timeouts.WHEEL.describe())]
+
+
+@httpd.http_handler('POST', 'connections/policy/update')
+def handle_update_connections_policy(environ, start_response):
+    # max_connections=0 and max_connection_lifetime= (empty) turn the limits off
+    arguments = environ['REQUEST_ARGUMENTS']
+    try:
+        if 'max_connections' in arguments:
+            timeouts.max_connections = int(arguments['max_connections'].value)
+        if 'max_connection_lifetime' in arguments:
+            value = arguments['max_connection_lifetime'].value
+            timeouts.max_connection_lifetime = int(value) if value else None
+        if 'half_close_linger' in arguments:
+            timeouts.half_close_linger = int(arguments['half_close_linger'].value)
+        if 'release_buffers_after' in arguments:
+            timeouts.release_buffers_after = int(arguments['release_buffers_after'].value)
+    except ValueError as e:
+        start_response(httplib.BAD_REQUEST, [('Content-Type', 'text/plain')])
+        return [str(e)]
+    LOGGER.info('connections policy updated: max connections %s, max lifetime %s, half close linger %s, '
+                'release buffers after %s' % (
+        timeouts.max_connections, timeouts.max_connection_lifetime, timeouts.half_close_linger,
+        timeouts.release_buffers_after))
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps(timeouts.WHEEL.describe())]
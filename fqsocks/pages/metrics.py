@@ -0,0 +1,36 @@
+import httplib
+import json
+
+from .. import httpd
+from .. import stat
+from .. import metrics
+from .. import sketches
+from .. import hub_monitor
+
+
+@httpd.http_handler('GET', 'metrics')
+def handle_metrics(environ, start_response):
+    start_response(httplib.OK, [('Content-Type', 'text/plain; version=0.0.4')])
+    return [metrics.render(stat.proxy_traffics)]
+
+
+@httpd.http_handler('GET', 'metrics/stages')
+def handle_stages(environ, start_response):
+    # proxy type => stage => seconds the stage took, from accept to the first upstream byte
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps(metrics.describe_stages())]
+
+
+@httpd.http_handler('GET', 'metrics/heavy-hitters')
+def handle_heavy_hitters(environ, start_response):
+    # top fall back reasons per proxy and hosts falling back as [item, count, error],
+    # hosts with the most bytes as [host, estimated bytes]
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps(sketches.describe())]
+
+
+@httpd.http_handler('GET', 'metrics/hub-blocked')
+def handle_hub_blocked(environ, start_response):
+    # the last greenlets that held the hub over the threshold, with their stacks
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps(list(hub_monitor.blocked_records))]
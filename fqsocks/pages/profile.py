@@ -0,0 +1,32 @@
+import httplib
+
+from .. import httpd
+from .. import profiler
+
+
+@httpd.http_handler('POST', 'profile/start')
+def handle_start_profile(environ, start_response):
+    # interval and duration in seconds, both optional
+    arguments = environ['REQUEST_ARGUMENTS']
+    try:
+        interval = float(arguments['interval'].value) if 'interval' in arguments else profiler.DEFAULT_INTERVAL
+        duration = float(arguments['duration'].value) if 'duration' in arguments else profiler.MAX_DURATION
+    except ValueError as e:
+        start_response(httplib.BAD_REQUEST, [('Content-Type', 'text/plain')])
+        return [str(e)]
+    if not profiler.start(interval, duration):
+        start_response(httplib.CONFLICT, [('Content-Type', 'text/plain')])
+        return ['already profiling']
+    start_response(httplib.OK, [('Content-Type', 'text/plain')])
+    return ['OK']
+
+
+@httpd.http_handler('POST', 'profile/stop')
+def handle_stop_profile(environ, start_response):
+    # collapsed stacks, feed them to flamegraph.pl
+    collapsed_stacks = profiler.stop()
+    if collapsed_stacks is None:
+        start_response(httplib.NOT_FOUND, [('Content-Type', 'text/plain')])
+        return ['not profiling']
+    start_response(httplib.OK, [('Content-Type', 'text/plain')])
+    return [collapsed_stacks]
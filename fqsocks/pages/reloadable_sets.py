@@ -0,0 +1,107 @@
+import httplib
+import json
+import logging
+import os
+import sys
+import time
+
+import gevent
+
+from .. import httpd
+from .. import china_ip
+from .. import host_set
+
+
+LOGGER = logging.getLogger(__name__)
+WATCH_INTERVAL = 10
+watch_greenlet = None
+reload_greenlets = {} # china/hosts => greenlet
+reload_results = {} # china/hosts => result of last reload
+
+
+@httpd.http_handler('POST', 'sets/reload')
+def handle_reload_sets(environ, start_response):
+    arguments = environ['REQUEST_ARGUMENTS']
+    names = [arguments['name'].value] if 'name' in arguments else ['china', 'hosts']
+    for name in names:
+        if name not in ('china', 'hosts'):
+            start_response(httplib.BAD_REQUEST, [('Content-Type', 'text/plain')])
+            return ['unknown set: %s' % name]
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps({name: reload_set(name) for name in names})]
+
+
+@httpd.http_handler('GET', 'sets')
+def handle_list_sets(environ, start_response):
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    return [json.dumps({
+        'china': describe(china_ip.CHINA_IP_INDEX),
+        'hosts': describe(host_set.index) if host_set.index else None,
+        'host_set_files': host_set.HOST_SET_FILES,
+        'last_reloads': reload_results
+    })]
+
+
+def reload_set(name):
+    # the new index is built aside in a thread of the hub threadpool, parsing and building are pure python
+    # and would hold the hub for the whole build in a greenlet. lookups keep using the old one until the swap
+    greenlet = reload_greenlets.get(name)
+    if greenlet is None or greenlet.ready():
+        greenlet = gevent.spawn(
+            gevent.get_hub().threadpool.apply, build_china_ip_index if 'china' == name else build_host_set_index)
+        reload_greenlets[name] = greenlet
+    try:
+        new_index, description = greenlet.get()
+    except:
+        LOGGER.exception('failed to reload %s' % name)
+        reload_results[name] = {'error': str(sys.exc_info()[1]), 'reloaded_at': time.time()}
+        return reload_results[name]
+    if 'china' == name:
+        china_ip.CHINA_IP_INDEX = new_index
+    else:
+        host_set.swap_index(new_index)
+    reload_results[name] = dict(description, reloaded_at=time.time())
+    LOGGER.info('reloaded %s: %s' % (name, reload_results[name]))
+    return reload_results[name]
+
+
+def build_china_ip_index():
+    started_at = time.time()
+    new_index = china_ip.load_china_ip_index()
+    return new_index, dict(describe(new_index), build_seconds=time.time() - started_at)
+
+
+def build_host_set_index():
+    started_at = time.time()
+    new_index = host_set.build_index()
+    return new_index, dict(describe(new_index), build_seconds=time.time() - started_at)
+
+
+def describe(index):
+    return {
+        'type': index.__class__.__name__,
+        'memory_bytes': index.memory_size()
+    }
+
+
+def watch_files():
+    if host_set.HOST_SET_FILES:
+        reload_set('hosts')
+    mtimes = {}
+    while True:
+        for name, files in [
+            ('china', [china_ip.CHINA_IP_TXT_FILE, china_ip.CHINA_IP_BIN_FILE]),
+            ('hosts', host_set.HOST_SET_FILES.values())]:
+            current_mtimes = [get_mtime(file_path) for file_path in files]
+            if name in mtimes and mtimes[name] != current_mtimes:
+                LOGGER.info('%s changed, reload' % files)
+                reload_set(name)
+            mtimes[name] = current_mtimes
+        gevent.sleep(WATCH_INTERVAL)
+
+
+def get_mtime(file_path):
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return 0
@@ -36,27 +36,11 @@ def handle_refresh_proxies(environ, start_response):
 @httpd.http_handler('GET', 'proxies')
 def handle_list_proxies(environ, start_response):
     start_response(httplib.OK, [('Content-Type', 'text/html')])
-    proxies_counters = {}
-    for counter in stat.counters:
-        proxies_counters.setdefault(counter.proxy.public_name, []).append(counter)
     after = time.time() - MAX_TIME_RANGE
     proxies_stats = {}
-    for proxy_public_name, proxy_counters in sorted(proxies_counters.items(),
-                                                    key=lambda (proxy_public_name, proxy_counters): proxy_public_name):
-        rx_bytes_list, rx_seconds_list, _ = zip(*[counter.total_rx(after) for counter in proxy_counters])
-        rx_bytes = sum(rx_bytes_list)
-        rx_seconds = sum(rx_seconds_list)
-        if rx_seconds:
-            rx_speed = rx_bytes / (rx_seconds * 1000)
-        else:
-            rx_speed = 0
-        tx_bytes_list, tx_seconds_list, _ = zip(*[counter.total_tx(after) for counter in proxy_counters])
-        tx_bytes = sum(tx_bytes_list)
-        tx_seconds = sum(tx_seconds_list)
-        if tx_seconds:
-            tx_speed = tx_bytes / (tx_seconds * 1000)
-        else:
-            tx_speed = 0
+    for proxy_public_name, traffic in stat.proxy_traffics.items():
+        rx_bytes, rx_seconds, rx_speed = traffic.total_rx(after)
+        tx_bytes, tx_seconds, tx_speed = traffic.total_tx(after)
         if not proxy_public_name:
             continue
         proxies_stats[proxy_public_name] = {
@@ -95,6 +79,28 @@ def handle_list_proxies(environ, start_response):
     return template.render(proxies_stats=proxies_stats).encode('utf8')
 
 
+@httpd.http_handler('GET', 'hosts/traffic')
+def handle_list_hosts_traffic(environ, start_response):
+    start_response(httplib.OK, [('Content-Type', 'application/json')])
+    after = time.time() - MAX_TIME_RANGE
+    hosts_stats = []
+    for host, traffic in stat.host_traffics.items():
+        rx_bytes, rx_seconds, rx_speed = traffic.total_rx(after)
+        tx_bytes, tx_seconds, tx_speed = traffic.total_tx(after)
+        if rx_bytes or tx_bytes:
+            hosts_stats.append({
+                'host': host,
+                'rx_bytes': rx_bytes,
+                'rx_seconds': rx_seconds,
+                'rx_speed': rx_speed,
+                'tx_bytes': tx_bytes,
+                'tx_seconds': tx_seconds,
+                'tx_speed': tx_speed
+            })
+    hosts_stats.sort(key=lambda host_stats: host_stats['rx_bytes'] + host_stats['tx_bytes'], reverse=True)
+    return [json.dumps(hosts_stats)]
+
+
 def enable_proxies():
     proxy_client.clear_proxy_states()
     gevent.spawn(proxy_client.init_proxies, config_file.read_config())
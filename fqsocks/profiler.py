@@ -0,0 +1,77 @@
+import logging
+import os
+import sys
+import time
+
+import gevent.monkey
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.005 # seconds between samples
+MAX_DURATION = 300 # seconds, a profiler nobody stopped stops by itself
+MAX_DEPTH = 64
+
+start_new_thread = gevent.monkey.get_original('thread', 'start_new_thread')
+get_ident = gevent.monkey.get_original('thread', 'get_ident')
+real_sleep = gevent.monkey.get_original('time', 'sleep')
+
+profiling = None
+
+
+class Profiling(object):
+    # samples from an os thread of its own, so it keeps sampling while a greenlet holds the hub.
+    # all greenlets run in the hub thread, the frame running in that thread is whatever greenlet runs at the moment
+    def __init__(self, interval, duration):
+        self.interval = interval
+        self.duration = duration
+        self.thread_id = get_ident()
+        self.started_at = time.time()
+        self.stopped = False
+        self.samples_count = 0
+        self.stacks = {} # collapsed stack => samples
+
+    def run(self):
+        ends_at = self.started_at + self.duration
+        try:
+            while not self.stopped and time.time() < ends_at:
+                real_sleep(self.interval)
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self.sample(frame)
+        except:
+            LOGGER.exception('failed to sample')
+        self.stopped = True
+
+    def sample(self, frame):
+        names = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            code = frame.f_code
+            names.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples_count += 1
+
+    def collapse(self):
+        # one line per stack, root first: a;b;c count. the format flamegraph.pl reads
+        return ''.join('%s %s\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+def start(interval=DEFAULT_INTERVAL, duration=MAX_DURATION):
+    global profiling
+    if profiling and not profiling.stopped:
+        return False
+    profiling = Profiling(interval, min(duration, MAX_DURATION))
+    start_new_thread(profiling.run, ())
+    LOGGER.info('profiling started, sample every %s seconds for at most %s seconds' % (
+        profiling.interval, profiling.duration))
+    return True
+
+
+def stop():
+    if not profiling:
+        return None
+    profiling.stopped = True
+    LOGGER.info('profiling stopped, %s samples in %0.1f seconds' % (
+        profiling.samples_count, time.time() - profiling.started_at))
+    return profiling.collapse()
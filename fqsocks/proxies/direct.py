@@ -1,20 +1,27 @@
 import logging
+import time
 from .. import networking
 from .. import ip_substitution
+from .. import metrics
+from . import registry
 
 LOGGER = logging.getLogger(__name__)
+LATENCY_EWMA_ALPHA = 0.3 # weight of a new sample
+LATENCY_HALF_LIFE = 300 # seconds, a latency not recorded for so long counts half as much
+LATENCY_MIN_CONFIDENCE = 0.1 # below it the latency is unknown again
 
 
 class Proxy(object):
     def __init__(self):
         super(Proxy, self).__init__()
-        self.died = False
+        self._died = False
         self.flags = set()
         self.priority = 0
         self.proxy_id = None
         self._proxy_ip = None
-        self.latency_records_total = 0
-        self.latency_records_count = 0
+        self.latency_ewma = None
+        self.latency_p90 = None
+        self.latency_recorded_at = None
         self.failed_times = 0
 
     def increase_failed_time(self):
@@ -24,24 +31,62 @@ class Proxy(object):
             self.died = True
             LOGGER.fatal('!!! proxy died !!!: %s' % self)
 
+    @property
+    def died(self):
+        return self._died
+
+    @died.setter
+    def died(self, value):
+        if value != self._died:
+            metrics.proxy_died_changed(self, value)
+            self._died = value
+            registry.proxy_changed(self)
+
     def record_latency(self, latency):
-        self.latency_records_total += latency
-        self.latency_records_count += 1
-        if self.latency_records_count > 100:
-            self.latency_records_total = self.latency
-            self.latency_records_count = 1
+        metrics.latency_recorded(self, latency)
+        confidence = self.latency_confidence
+        if not confidence:
+            self.latency_ewma = self.latency_p90 = latency
+        else:
+            alpha = max(LATENCY_EWMA_ALPHA, 1 - confidence) # old history counts less
+            self.latency_ewma += alpha * (latency - self.latency_ewma)
+            # up 0.9 step over it, down 0.1 step under it, settles where 10% of samples are over
+            step = alpha * self.latency_ewma
+            if latency > self.latency_p90:
+                self.latency_p90 += step * 0.9
+            else:
+                self.latency_p90 = max(self.latency_p90 - step * 0.1, 0)
+        self.latency_recorded_at = time.time()
+        registry.proxy_changed(self)
 
     def clear_latency_records(self):
-        self.latency_records_total = 0
-        self.latency_records_count = 0
+        self.latency_ewma = None
+        self.latency_p90 = None
+        self.latency_recorded_at = None
+
+    @property
+    def latency_confidence(self):
+        if self.latency_recorded_at is None:
+            return 0
+        confidence = 0.5 ** ((time.time() - self.latency_recorded_at) / LATENCY_HALF_LIFE)
+        return confidence if confidence >= LATENCY_MIN_CONFIDENCE else 0
+
+    @property
+    def latency_score(self):
+        # lower is picked first. unknown is 0, so the proxy gets tried and measured,
+        # an estimate not recorded for a while decays toward unknown
+        confidence = self.latency_confidence
+        if not confidence:
+            return 0
+        return (self.latency_ewma + self.latency_p90) / 2 * confidence
 
     def clear_failed_times(self):
         self.failed_times = 0
 
     @property
     def latency(self):
-        if self.latency_records_count:
-            return self.latency_records_total / self.latency_records_count
+        if self.latency_confidence:
+            return self.latency_ewma
         else:
             return 0
 
@@ -60,9 +105,14 @@ class Proxy(object):
 
     def forward(self, client):
         client.forwarding_by = self
+        counted = not hasattr(self, 'delegated_to') # counted as the proxy delegated to
+        if counted:
+            metrics.forward_started(client, self)
         try:
             self.do_forward(client)
         finally:
+            if counted:
+                metrics.forward_ended(client, self)
             if self.died:
                 LOGGER.fatal('[%s] !!! proxy died !!!: %s' % (repr(client), self))
                 client.dump_proxies()
@@ -79,11 +129,19 @@ class Proxy(object):
     def is_protocol_supported(self, protocol, client=None):
         return False
 
+    @property
+    def identity(self):
+        # what equal proxies share, it must not change while the proxy is in use, so no latency in it
+        return repr(self)
+
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        return self.identity == getattr(other, 'identity', None)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
-        return hash(repr(self))
+        return hash(self.identity)
 
     @property
     def public_name(self):
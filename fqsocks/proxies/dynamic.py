@@ -50,6 +50,13 @@ class DynamicProxy(Proxy):
         else:
             return 0
 
+    @property
+    def latency_score(self):
+        if self.delegated_to:
+            return self.delegated_to.latency_score
+        else:
+            return 0
+
     @property
     def died(self):
         if self.delegated_to:
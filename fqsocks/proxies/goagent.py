@@ -6,7 +6,6 @@ import time
 import sys
 import re
 import functools
-import fnmatch
 import urllib
 import httplib
 import random
@@ -22,6 +21,7 @@ import gevent.queue
 
 from .. import networking
 from .. import stat
+from .. import host_set
 from .direct import Proxy
 from .http_try import recv_and_parse_request, NotHttp
 from .http_try import CapturingSock
@@ -84,7 +84,7 @@ AUTORANGE_HOSTS = (
     'vs*.thisav.com',
     'archive.rthk.hk',
     'video*.modimovie.com')
-AUTORANGE_HOSTS_MATCH = [re.compile(fnmatch.translate(h)).match for h in AUTORANGE_HOSTS]
+host_set.register('autorange', AUTORANGE_HOSTS)
 AUTORANGE_ENDSWITH = '.f4v|.flv|.hlv|.m4v|.mp4|.mp3|.ogg|.avi|.exe|.zip|.iso|.rar|.bz2|.xz|.dmg'.split('|')
 AUTORANGE_ENDSWITH = tuple(AUTORANGE_ENDSWITH)
 AUTORANGE_NOENDSWITH = '.xml|.json|.html|.php|.py.js|.css|.jpg|.jpeg|.png|.gif|.ico'.split('|')
@@ -201,6 +201,10 @@ class GoAgentProxy(Proxy):
     def __repr__(self):
         return 'GoAgentProxy[%s ver %s]' % (self.appid, self.version)
 
+    @property
+    def identity(self):
+        return 'GoAgentProxy[%s]' % self.appid
+
     @property
     def public_name(self):
         return 'GoAgent\t%s' % self.appid
@@ -209,7 +213,7 @@ class GoAgentProxy(Proxy):
 def forward(client, proxy):
     parsed_url = urllib.parse.urlparse(client.url)
     range_in_query = 'range=' in parsed_url.query or 'redirect_counter=' in parsed_url.query
-    special_range = (any(x(client.host) for x in AUTORANGE_HOSTS_MATCH) or client.url.endswith(
+    special_range = (host_set.is_in(client.host, 'autorange') or client.url.endswith(
         AUTORANGE_ENDSWITH)) and not client.url.endswith(
         AUTORANGE_NOENDSWITH) and not 'redirector.c.youtube.com' == client.host
     if client.host in GoAgentProxy.gray_list:
@@ -91,6 +91,10 @@ class HttpConnectProxy(Proxy):
     def __repr__(self):
         return 'HttpConnectProxy[%s:%s %0.2f]' % (self.proxy_host, self.proxy_port, self.latency)
 
+    @property
+    def identity(self):
+        return 'HttpConnectProxy[%s:%s]' % (self.proxy_host, self.proxy_port)
+
     @property
     def public_name(self):
         return 'HTTP\t%s' % self.proxy_host
@@ -78,6 +78,10 @@ class HttpRelayProxy(Proxy):
     def __repr__(self):
         return 'HttpRelayProxy[%s:%s %0.2f]' % (self.proxy_host, self.proxy_port, self.latency)
 
+    @property
+    def identity(self):
+        return 'HttpRelayProxy[%s:%s]' % (self.proxy_host, self.proxy_port)
+
     @property
     def public_name(self):
         return 'HTTP\t%s' % self.proxy_host
@@ -4,13 +4,13 @@ import socket
 import sys
 import StringIO
 import gzip
-import fnmatch
 import time
 import gevent
 
 from .direct import Proxy
 from .. import networking
 from .. import ip_substitution
+from .. import host_set
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,7 +26,7 @@ NO_DIRECT_PROXY_HOSTS = {
     'skype.com',
     '*.skype.com',
     'radiotime.com',
-    '*.radiotime.com'
+    '*.radiotime.com',
     'myfreecams.com',
     '*.myfreecams.com'
 }
@@ -38,9 +38,23 @@ WHITE_LIST = {
     'google.com.hk',
 }
 
+BLOCKED_GOOGLE_HOSTS = {
+    'youtube.com',
+    '*.youtube.com',
+    'ytimg.com',
+    '*.ytimg.com',
+    'googlevideo.com',
+    '*.googlevideo.com',
+    '*.c.android.clients.google.com' # google play apk
+}
+
+host_set.register('no_direct', NO_DIRECT_PROXY_HOSTS)
+host_set.register('white_list', WHITE_LIST)
+host_set.register('blocked_google', BLOCKED_GOOGLE_HOSTS)
+
 
 def is_no_direct_host(client_host):
-    return any(fnmatch.fnmatch(client_host, host) for host in NO_DIRECT_PROXY_HOSTS)
+    return host_set.is_in(client_host, 'no_direct')
 
 
 class HttpTryProxy(Proxy):
@@ -63,7 +77,7 @@ class HttpTryProxy(Proxy):
         except NotHttp:
             raise
         except:
-            if client.host and client.host not in WHITE_LIST:
+            if client.host and not host_set.is_in(client.host, 'white_list'):
                 self.host_black_list[client.host] = self.host_black_list.get(client.host, 0) + 1
                 if self.host_black_list[client.host] == 4:
                     LOGGER.error('blacklist host %s' % client.host)
@@ -279,10 +293,7 @@ def fallback_if_youtube_unplayable(client, http_response):
 
 
 def is_blocked_google_host(client_host):
-    if not client_host:
-        return False
-    return 'youtube.com' in client_host or 'ytimg.com' in client_host or 'googlevideo.com' in client_host \
-        or '.c.android.clients.google.com' in client_host # google play apk
+    return host_set.is_in(client_host, 'blocked_google')
 
 
 def try_receive_response_header(client, upstream_sock, rejects_error=False):
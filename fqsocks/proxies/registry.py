@@ -0,0 +1,118 @@
+import logging
+import time
+import bisect
+import random
+
+LOGGER = logging.getLogger(__name__)
+
+REINDEX_INTERVAL = 60 # seconds, latency scores decay with time, not only when recorded
+PICK_AMONG = 3 # lowest scores of the highest priority
+
+
+class ProtocolIndex(object):
+    # live proxies supporting one protocol, bucketed by priority, each bucket kept sorted by latency score
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.priorities = [] # sorted, lower is picked first
+        self.buckets = {} # priority => sorted [(latency score, order, proxy)]
+        self.entries = {} # id of proxy => (priority, entry). by id, proxies equal by identity are still many
+
+    def add(self, proxy, order):
+        priority = proxy.priority
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets[priority] = []
+            bisect.insort(self.priorities, priority)
+        entry = (proxy.latency_score, order, proxy)
+        bisect.insort(bucket, entry)
+        self.entries[id(proxy)] = (priority, entry)
+
+    def remove(self, proxy):
+        priority, entry = self.entries.pop(id(proxy))
+        bucket = self.buckets[priority]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if not bucket:
+            del self.buckets[priority]
+            self.priorities.remove(priority)
+
+    def pick(self, has_tried):
+        for priority in self.priorities:
+            candidates = []
+            for score, order, proxy in self.buckets[priority]:
+                if not has_tried(proxy):
+                    candidates.append(proxy)
+                    if len(candidates) == PICK_AMONG:
+                        break
+            if candidates:
+                return random.choice(candidates)
+        return None
+
+
+class ProxyRegistry(object):
+    # indexes proxy_client.proxies, which is appended to and replaced in many places,
+    # so sync notices a different list or length and builds the index again.
+    # died and latency changes of a proxy, or of the proxy a dynamic proxy delegates to, move just that proxy
+    def __init__(self):
+        self.proxies = None
+        self.proxies_count = 0
+        self.indexed_at = 0
+        self.orders = {} # id of proxy => position in proxies, entries of equal score keep it
+        self.owners = {} # id of proxy changed => the proxies indexed for it
+        self.indexes = {} # protocol => ProtocolIndex, made when a protocol is first asked for
+
+    def sync(self, proxies):
+        if proxies is not self.proxies or len(proxies) != self.proxies_count \
+                or time.time() - self.indexed_at > REINDEX_INTERVAL:
+            self.build(proxies)
+
+    def build(self, proxies):
+        self.proxies = proxies
+        self.proxies_count = len(proxies)
+        self.indexed_at = time.time()
+        self.orders = {}
+        self.owners = {}
+        for order, proxy in enumerate(proxies):
+            self.orders[id(proxy)] = order
+            self.owners.setdefault(id(proxy), []).append(proxy)
+            delegated_to = getattr(proxy, 'delegated_to', None)
+            if delegated_to is not None:
+                self.owners.setdefault(id(delegated_to), []).append(proxy)
+        for protocol in self.indexes.keys():
+            self.indexes[protocol] = self.build_index(protocol)
+
+    def build_index(self, protocol):
+        index = ProtocolIndex(protocol)
+        for proxy in self.proxies or ():
+            if proxy.is_protocol_supported(protocol) and not proxy.died:
+                index.add(proxy, self.orders[id(proxy)])
+        return index
+
+    def index(self, protocol):
+        index = self.indexes.get(protocol)
+        if index is None:
+            index = self.indexes[protocol] = self.build_index(protocol)
+        return index
+
+    def changed(self, changed_proxy):
+        for proxy in self.owners.get(id(changed_proxy), ()):
+            for index in self.indexes.values():
+                if id(proxy) in index.entries:
+                    index.remove(proxy)
+                if proxy.is_protocol_supported(index.protocol) and not proxy.died:
+                    index.add(proxy, self.orders[id(proxy)])
+
+    def pick(self, protocol, has_tried):
+        return self.index(protocol).pick(has_tried)
+
+    def all_died(self, protocol):
+        return not self.index(protocol).entries
+
+
+REGISTRY = ProxyRegistry()
+
+
+def proxy_changed(proxy):
+    try:
+        REGISTRY.changed(proxy)
+    except:
+        LOGGER.exception('failed to index changed proxy: %r' % proxy)
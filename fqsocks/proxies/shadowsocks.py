@@ -56,6 +56,10 @@ class ShadowSocksProxy(Proxy):
     def __repr__(self):
         return 'ShadowSocksProxy[%s:%s %0.2f]' % (self.proxy_host, self.proxy_port, self.latency)
 
+    @property
+    def identity(self):
+        return 'ShadowSocksProxy[%s:%s]' % (self.proxy_host, self.proxy_port)
+
     @property
     def public_name(self):
         return 'SS\t%s' % self.proxy_host
\ No newline at end of file
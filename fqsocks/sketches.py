@@ -0,0 +1,95 @@
+import logging
+import array
+
+LOGGER = logging.getLogger(__name__)
+
+TOP_REASONS = 16 # per proxy
+TOP_HOSTS = 32
+COUNT_MIN_WIDTH = 2048
+COUNT_MIN_DEPTH = 4
+
+
+class SpaceSaving(object):
+    # keeps at most capacity items. a new item takes over the smallest count when full,
+    # so the count might be over by at most the count it took over, which is kept as its error
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {} # item => [count, error]
+
+    def add(self, item, count=1):
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += count
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = [count, 0]
+            return
+        smallest = min(self.counts, key=lambda item: self.counts[item][0])
+        smallest_count = self.counts.pop(smallest)[0]
+        self.counts[item] = [smallest_count + count, smallest_count]
+
+    def top(self):
+        return sorted(([item, count, error] for item, (count, error) in self.counts.items()),
+                      key=lambda (item, count, error): count, reverse=True)
+
+
+class CountMinSketch(object):
+    # depth rows of width counters, an item adds to one counter per row and is estimated by the smallest of them,
+    # never under the truth. the top items are tracked by their estimates next to the sketch
+    def __init__(self, width, depth, top_count):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array('d', [0]) * width for i in range(depth)]
+        self.top_count = top_count
+        self.top_items = {} # item => estimate
+
+    def add(self, item, count):
+        hash1 = hash(item)
+        hash2 = (hash1 >> 16) | 1
+        estimate = None
+        for i, row in enumerate(self.rows):
+            index = (hash1 + i * hash2) % self.width
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        if item in self.top_items or len(self.top_items) < self.top_count:
+            self.top_items[item] = estimate
+            return
+        smallest = min(self.top_items, key=self.top_items.get)
+        if estimate > self.top_items[smallest]:
+            del self.top_items[smallest]
+            self.top_items[item] = estimate
+
+    def estimate(self, item):
+        hash1 = hash(item)
+        hash2 = (hash1 >> 16) | 1
+        return min(row[(hash1 + i * hash2) % self.width] for i, row in enumerate(self.rows))
+
+    def top(self):
+        return sorted(([item, int(self.estimate(item))] for item in self.top_items),
+                      key=lambda (item, estimate): estimate, reverse=True)
+
+
+fall_back_reasons = {} # proxy => SpaceSaving of reasons
+fall_back_hosts = SpaceSaving(TOP_HOSTS)
+host_bytes = CountMinSketch(COUNT_MIN_WIDTH, COUNT_MIN_DEPTH, TOP_HOSTS)
+
+
+def fell_back(proxy_name, host, reason):
+    reasons = fall_back_reasons.get(proxy_name)
+    if reasons is None:
+        reasons = fall_back_reasons[proxy_name] = SpaceSaving(TOP_REASONS)
+    reasons.add(reason)
+    fall_back_hosts.add(host)
+
+
+def host_bytes_added(host, rx_bytes, tx_bytes):
+    host_bytes.add(host, rx_bytes + tx_bytes)
+
+
+def describe():
+    return {
+        'fall_back_reasons': {proxy_name: reasons.top() for proxy_name, reasons in fall_back_reasons.items()},
+        'fall_back_hosts': fall_back_hosts.top(),
+        'host_bytes': host_bytes.top()
+    }
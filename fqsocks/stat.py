@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
 import time
 import logging
+import array
+import functools
+
+from . import sketches
 
 LOGGER = logging.getLogger(__name__)
 
-counters = [] # not closed or closed within 5 minutes
+proxy_traffics = {} # proxy public name => traffic of all its counters
+host_traffics = {} # host (or ip) => traffic of all its counters
 
 MAX_TIME_RANGE = 60 * 10
+BUCKET_FIELDS = 5
+SECOND, RX_BYTES, RX_SECONDS, TX_BYTES, TX_SECONDS = range(BUCKET_FIELDS)
+MAX_HOST_TRAFFICS = 1024
 
 def opened(attached_to_resource, proxy, host, ip):
     if hasattr(proxy, 'resolved_by_dynamic_proxy'):
@@ -22,32 +30,128 @@ def opened(attached_to_resource, proxy, host, ip):
 
     attached_to_resource.close = new_close
     if '127.0.0.1' != counter.ip:
-        counters.append(counter)
-    clean_counters()
+        if proxy is not None and proxy.public_name:
+            counter.traffics.append(get_proxy_traffic(proxy.public_name))
+        counter.traffics.append(get_host_traffic(host or ip))
     return counter
 
 
-def clean_counters():
-    global counters
-    try:
-        expired_counters = find_expired_counters()
-        for counter in expired_counters:
-            counters.remove(counter)
-    except:
-        LOGGER.exception('failed to clean counters')
-        counters = []
-
-
-def find_expired_counters():
-    now = time.time()
-    expired_counters = []
-    for counter in counters:
-        counter_time = counter.closed_at or counter.opened_at
-        if now - counter_time > MAX_TIME_RANGE:
-            expired_counters.append(counter)
-        else:
-            return expired_counters
-    return []
+def get_proxy_traffic(proxy_public_name):
+    traffic = proxy_traffics.get(proxy_public_name)
+    if traffic is None:
+        traffic = proxy_traffics[proxy_public_name] = Traffic()
+    return traffic
+
+
+def get_host_traffic(host):
+    traffic = host_traffics.get(host)
+    if traffic is None:
+        if len(host_traffics) >= MAX_HOST_TRAFFICS:
+            forget_host_traffics()
+        traffic = host_traffics[host] = Traffic(on_second=functools.partial(sketches.host_bytes_added, host))
+    return traffic
+
+
+def forget_host_traffics():
+    # hosts without traffic in the time range go first, then the least recently active half.
+    # counters still open keep adding to the traffic forgotten, it is just not reported any more
+    after = time.time() - MAX_TIME_RANGE
+    for host, traffic in host_traffics.items():
+        if traffic.second + 1 <= after:
+            del host_traffics[host]
+    if len(host_traffics) >= MAX_HOST_TRAFFICS:
+        hosts = sorted(host_traffics, key=lambda host: host_traffics[host].second)
+        for host in hosts[:len(hosts) / 2]:
+            del host_traffics[host]
+
+
+def clear():
+    proxy_traffics.clear()
+    host_traffics.clear()
+
+
+class Traffic(object):
+    # traffic is added up into per second buckets, kept in a ring of at most MAX_TIME_RANGE seconds,
+    # so it grows with the seconds it has traffic in, not with the number of recv and send.
+    # the bucket of the current second lives in attributes and goes into the ring when the second is over.
+    # kept per proxy and per host, every counter adds to the traffic of its proxy and host
+    def __init__(self, on_second=None):
+        self.on_second = on_second # called with the rx and tx bytes of every second with traffic
+        self.buckets = array.array('d') # BUCKET_FIELDS per bucket
+        self.oldest_bucket = 0 # offset of the oldest bucket once the ring is full
+        self.second = int(time.time())
+        self.second_ends_at = self.second + 1
+        self.rx_bytes = 0
+        self.rx_seconds = 0
+        self.tx_bytes = 0
+        self.tx_seconds = 0
+        self.lifetime_rx_bytes = 0 # never rolled out of the ring
+        self.lifetime_tx_bytes = 0
+
+    def add(self, now, rx_bytes, rx_seconds, tx_bytes, tx_seconds):
+        if now >= self.second_ends_at:
+            self.next_second(int(now))
+        self.rx_bytes += rx_bytes
+        self.rx_seconds += rx_seconds
+        self.tx_bytes += tx_bytes
+        self.tx_seconds += tx_seconds
+        self.lifetime_rx_bytes += rx_bytes
+        self.lifetime_tx_bytes += tx_bytes
+
+    def next_second(self, second):
+        if self.rx_bytes or self.tx_bytes:
+            if self.on_second:
+                self.on_second(self.rx_bytes, self.tx_bytes)
+            bucket = (self.second, self.rx_bytes, self.rx_seconds, self.tx_bytes, self.tx_seconds)
+            buckets = self.buckets
+            if len(buckets) < MAX_TIME_RANGE * BUCKET_FIELDS:
+                buckets.extend(bucket)
+            else:
+                offset = self.oldest_bucket
+                buckets[offset:offset + BUCKET_FIELDS] = array.array('d', bucket)
+                self.oldest_bucket = (offset + BUCKET_FIELDS) % len(buckets)
+        self.second = second
+        self.second_ends_at = second + 1
+        self.rx_bytes = 0
+        self.rx_seconds = 0
+        self.tx_bytes = 0
+        self.tx_seconds = 0
+
+    def sum_buckets(self, after, bytes_field, seconds_field):
+        bytes = 0
+        seconds = 0
+        buckets = self.buckets
+        for offset in xrange(0, len(buckets), BUCKET_FIELDS):
+            if buckets[offset + SECOND] + 1 > after:
+                bytes += buckets[offset + bytes_field]
+                seconds += buckets[offset + seconds_field]
+        return int(bytes), seconds
+
+    def sum_rx(self, after=0):
+        bytes, seconds = self.sum_buckets(after, RX_BYTES, RX_SECONDS)
+        if self.second + 1 > after:
+            bytes += self.rx_bytes
+            seconds += self.rx_seconds
+        return bytes, seconds
+
+    def sum_tx(self, after=0):
+        bytes, seconds = self.sum_buckets(after, TX_BYTES, TX_SECONDS)
+        if self.second + 1 > after:
+            bytes += self.tx_bytes
+            seconds += self.tx_seconds
+        return bytes, seconds
+
+    def total_rx(self, after=0):
+        return with_speed(*self.sum_rx(after))
+
+    def total_tx(self, after=0):
+        return with_speed(*self.sum_tx(after))
+
+
+def with_speed(bytes, seconds):
+    if not bytes:
+        return 0, 0, 0
+    return bytes, seconds, bytes / (seconds * 1000) if seconds else 0
 
 
 class Counter(object):
@@ -57,61 +161,47 @@ class Counter(object):
         self.ip = ip
         self.opened_at = time.time()
         self.closed_at = None
-        self.events = []
+        self.traffics = [] # of its proxy and host
+        self.last_event_at = self.opened_at
+        self.pending_tx_bytes = 0 # sent but not answered by any rx yet
+        self.pending_tx_since = None
+        self.last_tx_at = None
 
     def sending(self, bytes_count):
-        self.events.append(('tx', time.time(), bytes_count))
-
+        now = time.time()
+        if self.pending_tx_since is None:
+            self.pending_tx_since = now
+        self.pending_tx_bytes += bytes_count
+        self.last_tx_at = now
+        self.last_event_at = now
 
     def received(self, bytes_count):
-        self.events.append(('rx', time.time(), bytes_count))
-
-    def total_rx(self, after=0):
-        if not self.events:
-            return 0, 0, 0
-        bytes = 0
-        seconds = 0
-        last_event_time = self.opened_at
-        for event_type, event_time, event_bytes in self.events:
-            if event_time > after and 'rx' == event_type:
-                seconds += (event_time - last_event_time)
-                bytes += event_bytes
-            last_event_time = event_time
-        if not bytes:
-            return 0, 0, 0
-        return bytes, seconds, bytes / (seconds * 1000)
-
-    def total_tx(self, after=0):
-        if not self.events:
-            return 0, 0, 0
-        bytes = 0
-        seconds = 0
-        pending_tx_events = []
-        for event_type, event_time, event_bytes in self.events:
-            if event_time > after:
-                if 'tx' == event_type:
-                    pending_tx_events.append((event_time, event_bytes))
-                else:
-                    if pending_tx_events:
-                        seconds += (event_time - pending_tx_events[-1][0])
-                        bytes += sum(b for _, b in pending_tx_events)
-                    pending_tx_events = []
-        if pending_tx_events:
-            seconds += ((self.closed_at or time.time()) - pending_tx_events[0][0])
-            bytes += sum(b for _, b in pending_tx_events)
-        if not bytes:
-            return 0, 0, 0
-        return bytes, seconds, bytes / (seconds * 1000)
+        now = time.time()
+        rx_seconds = now - self.last_event_at
+        if self.pending_tx_since is None:
+            tx_bytes = tx_seconds = 0
+        else:
+            # tx takes the time from the last send till the answer
+            tx_bytes = self.pending_tx_bytes
+            tx_seconds = now - self.last_tx_at
+            self.pending_tx_bytes = 0
+            self.pending_tx_since = None
+        self.last_event_at = now
+        for traffic in self.traffics:
+            traffic.add(now, bytes_count, rx_seconds, tx_bytes, tx_seconds)
 
     def close(self):
         if not self.closed_at:
             self.closed_at = time.time()
+            if self.pending_tx_since is not None:
+                # upload only connections never receive, the pending bytes would be lost
+                tx_seconds = self.closed_at - self.last_tx_at
+                for traffic in self.traffics:
+                    traffic.add(self.closed_at, 0, 0, self.pending_tx_bytes, tx_seconds)
+                self.pending_tx_bytes = 0
+                self.pending_tx_since = None
 
     def __str__(self):
-        rx_bytes, rx_seconds, rx_speed = self.total_rx()
-        tx_bytes, tx_seconds, tx_speed = self.total_tx()
-        return '[%s~%s] %s%s via %s rx %0.2fKB/s(%s/%s) tx %0.2fKB/s(%s/%s)' % (
+        return '[%s~%s] %s%s via %s' % (
             self.opened_at, self.closed_at or '',
-            self.ip, '(%s)' % self.host if self.host else '', self.proxy,
-            rx_speed, rx_bytes, rx_seconds,
-            tx_speed, tx_bytes, tx_seconds)
\ No newline at end of file
+            self.ip, '(%s)' % self.host if self.host else '', self.proxy)
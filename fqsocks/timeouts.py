@@ -0,0 +1,209 @@
+import logging
+import math
+import time
+import itertools
+import collections
+
+import gevent
+
+
+LOGGER = logging.getLogger(__name__)
+TICK = 1 # second
+SLOTS_PER_LEVEL = 64 # level 0 spans a minute, level 1 an hour, level 2 three days
+LEVELS = 3
+
+max_connections = 0 # 0 means no limit, otherwise the connection idle the longest is reaped
+max_connection_lifetime = None # seconds, None means no limit
+half_close_linger = 30 # seconds upstream may stay silent after downstream sent eof
+release_buffers_after = 60 # seconds, idle connections drop their buffers until the next activity
+
+
+class Deadline(object):
+    # deadlines of one forwarding connection: first byte or idle timeout counted from the last activity,
+    # and an absolute lifetime. touch() only moves active_at to the time of the last tick,
+    # the wheel files the deadline again when its slot comes up and it turns out to be not due yet.
+    # on_idle is called once the connection has been idle for release_buffers_after.
+    # max_timeout caps every later set_timeout, a half closed connection keeps its linger
+    __slots__ = ('description', 'on_expired', 'timeout', 'max_timeout', 'lifetime', 'started_at', 'active_at', 'slot',
+                 'on_idle', 'idle_after', 'is_idle')
+
+    def __init__(self, description, on_expired, timeout, lifetime=None, on_idle=None):
+        self.description = description
+        self.on_expired = on_expired
+        self.timeout = timeout
+        self.max_timeout = None
+        self.lifetime = lifetime
+        self.started_at = self.active_at = time.time()
+        self.slot = None # the slot list it is filed in, copies left in other slots are stale
+        self.on_idle = on_idle
+        self.idle_after = release_buffers_after if on_idle else None
+        self.is_idle = False
+
+    def touch(self):
+        if self.active_at != WHEEL.now:
+            self.active_at = WHEEL.now
+            WHEEL.touched(self)
+        if self.is_idle:
+            self.is_idle = False
+            if self in WHEEL.deadlines:
+                WHEEL.file(self)
+
+    def set_timeout(self, timeout):
+        if self.max_timeout is not None and (timeout is None or timeout > self.max_timeout):
+            timeout = self.max_timeout
+        self.timeout = timeout
+        if self in WHEEL.deadlines:
+            WHEEL.file(self) # the new timeout might be shorter
+
+    def limit_timeout(self, max_timeout):
+        self.max_timeout = max_timeout
+        if self.timeout is None or self.timeout > max_timeout:
+            self.set_timeout(max_timeout)
+
+    @property
+    def expires_at(self):
+        expires_at = None
+        if self.timeout is not None:
+            expires_at = self.active_at + self.timeout
+        if self.lifetime is not None:
+            lifetime_ends_at = self.started_at + self.lifetime
+            if expires_at is None or lifetime_ends_at < expires_at:
+                expires_at = lifetime_ends_at
+        return expires_at
+
+    @property
+    def due_at(self):
+        expires_at = self.expires_at
+        if self.idle_after is None or self.is_idle:
+            return expires_at
+        idle_at = self.active_at + self.idle_after
+        return idle_at if expires_at is None or idle_at < expires_at else expires_at
+
+
+class TimingWheel(object):
+    # hierarchical timing wheel, filing and cancelling are O(1), each tick only looks at one slot
+    # per level. a deadline in a coarse level falls to a finer one when its slot comes up.
+    # deadlines are also kept in the order they were last active, so the idlest is reaped in O(1)
+    def __init__(self):
+        self.started_at = self.now = time.time()
+        self.ticks = 0
+        self.levels = [[[] for i in range(SLOTS_PER_LEVEL)] for level in range(LEVELS)]
+        self.deadlines = collections.OrderedDict() # deadline => None, the idlest first
+        self.expired_count = 0
+        self.reaped_count = 0
+        self.ticker = None
+
+    def add(self, deadline):
+        # now is only advanced by the ticker, which is not running before the first connection
+        self.now = time.time()
+        if self.ticker is None:
+            self.started_at = self.now
+            self.ticker = gevent.spawn(self.tick_forever)
+        self.deadlines[deadline] = None
+        self.file(deadline)
+        if max_connections and len(self.deadlines) > max_connections:
+            self.reap()
+
+    def cancel(self, deadline):
+        self.deadlines.pop(deadline, None)
+        deadline.slot = None
+        # copies left in slots until they come up must not keep the connection alive
+        deadline.on_expired = deadline.on_idle = None
+
+    def touched(self, deadline):
+        if deadline in self.deadlines:
+            del self.deadlines[deadline]
+            self.deadlines[deadline] = None
+
+    def file(self, deadline):
+        due_at = deadline.due_at
+        if due_at is None:
+            deadline.slot = None # filed again by set_timeout or touch
+            return
+        due_tick = max(self.ticks + 1, int(math.ceil((due_at - self.started_at) / TICK)))
+        ticks = due_tick - self.ticks
+        span = 1
+        for level in range(LEVELS):
+            if ticks < span * SLOTS_PER_LEVEL or level == LEVELS - 1:
+                break
+            span *= SLOTS_PER_LEVEL
+        slot = self.levels[level][(due_tick // span) % SLOTS_PER_LEVEL]
+        slot.append(deadline)
+        deadline.slot = slot
+
+    def tick_forever(self):
+        while True:
+            gevent.sleep(TICK)
+            try:
+                self.advance(time.time())
+            except:
+                LOGGER.exception('failed to advance timing wheel')
+
+    def advance(self, now):
+        self.now = now
+        due_ticks = int((now - self.started_at) / TICK)
+        while self.ticks < due_ticks:
+            self.ticks += 1
+            span = 1
+            for level in range(LEVELS):
+                if self.ticks % span:
+                    break
+                index = (self.ticks // span) % SLOTS_PER_LEVEL
+                slot = self.levels[level][index]
+                self.levels[level][index] = []
+                for deadline in slot:
+                    if deadline.slot is slot:
+                        self.expire_or_file(deadline)
+                span *= SLOTS_PER_LEVEL
+
+    def expire_or_file(self, deadline):
+        expires_at = deadline.expires_at
+        if expires_at is not None and expires_at <= self.now:
+            self.expired_count += 1
+            self.expire(deadline)
+            return
+        if deadline.idle_after is not None and not deadline.is_idle \
+                and deadline.active_at + deadline.idle_after <= self.now:
+            deadline.is_idle = True
+            try:
+                deadline.on_idle()
+            except:
+                LOGGER.exception('failed to handle idle: %s' % deadline.description)
+            if deadline not in self.deadlines:
+                return # cancelled by on_idle
+        self.file(deadline)
+
+    def reap(self):
+        deadline = next(iter(self.deadlines))
+        LOGGER.info('reap connection idle for %0.1f seconds: %s' % (self.now - deadline.active_at, deadline.description))
+        self.reaped_count += 1
+        self.expire(deadline)
+
+    def expire(self, deadline):
+        on_expired = deadline.on_expired
+        self.cancel(deadline)
+        try:
+            on_expired()
+        except:
+            LOGGER.exception('failed to expire: %s' % deadline.description)
+
+    def describe(self, idlest_count=10):
+        idlest = list(itertools.islice(self.deadlines, idlest_count))
+        return {
+            'connections': len(self.deadlines),
+            'idle_connections': sum(1 for deadline in self.deadlines if deadline.is_idle),
+            'expired': self.expired_count,
+            'reaped': self.reaped_count,
+            'max_connections': max_connections,
+            'max_connection_lifetime': max_connection_lifetime,
+            'half_close_linger': half_close_linger,
+            'release_buffers_after': release_buffers_after,
+            'idlest': [{
+                'description': deadline.description,
+                'idle_seconds': self.now - deadline.active_at,
+                'timeout': deadline.timeout
+            } for deadline in idlest]
+        }
+
+
+WHEEL = TimingWheel()